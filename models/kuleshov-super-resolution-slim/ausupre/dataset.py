@@ -0,0 +1,132 @@
+import glob
+import numpy as np
+import os
+from scipy.io import wavfile
+from tensorflow.keras.utils import Sequence
+
+CLEAN = 'clean'
+DEGRADED = 'degraded'
+
+
+def split_sample(sample, frame_length, step):
+    """Frames `step` apart, as a strided view of the sample (no copy)."""
+    if len(sample) < frame_length:
+        return np.empty((0, frame_length), dtype=sample.dtype)
+    return np.lib.stride_tricks.sliding_window_view(sample, frame_length)[::step]
+
+
+def shard_path(output_dir, kind, index):
+    return os.path.join(output_dir, f'{kind}-{index:05d}.npy')
+
+
+class ShardWriter:
+    """Collects aligned frame pairs and saves them in `.npy` shards of `shard_size` frames.
+
+    Only one shard is held in memory, however large the corpus.
+    """
+
+    def __init__(self, output_dir, frame_length, shard_size, dtype=np.int16):
+        os.makedirs(output_dir, exist_ok=True)
+        self.output_dir = output_dir
+        self.clean = np.empty((shard_size, frame_length), dtype=dtype)
+        self.degraded = np.empty((shard_size, frame_length), dtype=dtype)
+        self.size = 0
+        self.shards = 0
+        self.frames = 0
+
+    def add(self, clean, degraded):
+        s = 0
+        while s < len(clean):
+            n = min(len(self.clean) - self.size, len(clean) - s)
+            self.clean[self.size:self.size + n] = clean[s:s + n]
+            self.degraded[self.size:self.size + n] = degraded[s:s + n]
+            self.size += n
+            s += n
+            if self.size == len(self.clean):
+                self.save()
+
+    def save(self):
+        if not self.size:
+            return
+        np.save(shard_path(self.output_dir, CLEAN, self.shards), self.clean[:self.size])
+        np.save(shard_path(self.output_dir, DEGRADED, self.shards), self.degraded[:self.size])
+        self.shards += 1
+        self.frames += self.size
+        self.size = 0
+
+
+def build(pairs, output_dir, frame_length, step, shard_size):
+    """Frames each (clean, degraded) pair of WAV files into shards of `output_dir`."""
+    writer = ShardWriter(output_dir, frame_length, shard_size)
+
+    for clean_path, degraded_path in pairs:
+        # Memory mapped, a file is read a shard at a time.
+        clean_rate, clean = wavfile.read(clean_path, mmap=True)
+        degraded_rate, degraded = wavfile.read(degraded_path, mmap=True)
+        if clean_rate != degraded_rate:
+            raise ValueError(f'{degraded_path}: {degraded_rate} Hz, {clean_path}: {clean_rate} Hz')
+
+        # The codec may pad the end, frames are cut from the common length.
+        length = min(len(clean), len(degraded))
+        writer.add(split_sample(clean[:length], frame_length, step),
+                   split_sample(degraded[:length], frame_length, step))
+        del clean, degraded
+
+    writer.save()
+    return writer.shards, writer.frames
+
+
+def load(output_dir):
+    """(clean, degraded) memory maps of every shard in `output_dir`."""
+    shards = []
+    for clean_path in sorted(glob.glob(os.path.join(output_dir, f'{CLEAN}-*.npy'))):
+        degraded_path = clean_path.replace(f'{CLEAN}-', f'{DEGRADED}-')
+        clean, degraded = np.load(clean_path, mmap_mode='r'), np.load(degraded_path, mmap_mode='r')
+        if clean.shape != degraded.shape:
+            raise ValueError(f'{degraded_path}: shape {degraded.shape}, {clean_path}: shape {clean.shape}')
+        shards.append((clean, degraded))
+    if not shards:
+        raise ValueError(f'No shards in {output_dir}')
+
+    # The frame length is only recorded in the .npy headers.
+    if len({clean.shape[1] for clean, _ in shards}) > 1:
+        raise ValueError(f'Shards of {output_dir} differ in frame length')
+    return shards
+
+
+class FrameSequence(Sequence):
+    """Batches of (degraded, clean) frames read from memory mapped shards.
+
+    Each batch comes from a single shard, so it's read from one place on disk;
+    the order of batches and of frames within shards is shuffled every epoch.
+    """
+
+    def __init__(self, output_dir, batch_size, shuffle=True, **kwargs):
+        super().__init__(**kwargs)
+        self.shards = load(output_dir)
+        self.frame_length = self.shards[0][0].shape[1]
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.batches = [
+            (i, s) for i, (clean, _) in enumerate(self.shards) for s in range(0, len(clean), batch_size)
+        ]
+        self.order = [np.arange(len(clean)) for clean, _ in self.shards]
+        self.on_epoch_end()
+
+    def __len__(self):
+        return len(self.batches)
+
+    def __getitem__(self, index):
+        shard, start = self.batches[index]
+        clean, degraded = self.shards[shard]
+        # Sorted, the rows are read in file order.
+        rows = np.sort(self.order[shard][start:start + self.batch_size])
+        return (degraded[rows].astype(np.float32)[:, :, np.newaxis],
+                clean[rows].astype(np.float32)[:, :, np.newaxis])
+
+    def on_epoch_end(self):
+        if not self.shuffle:
+            return
+        np.random.shuffle(self.batches)
+        for order in self.order:
+            np.random.shuffle(order)
@@ -1,81 +1,287 @@
-# Apply trained model to a single recording.
+# Apply trained model to a recording of any length, streamed through in overlapping frames.
+#   python scripts/inference.py model.h5 noisy.wav clean.wav
+#   sox noisy.mp3 -t raw -r 16000 -b 16 -e signed -c 1 - | python scripts/inference.py model.h5 - - | aplay -f S16_LE -r 16000
+# '-' reads and writes raw 16 bit mono PCM on stdin/stdout.
 import argparse
+import multiprocessing
 import numpy as np
 import os
+import sys
 import tensorflow as tf
 import time
-from scipy.io import wavfile
+import wave
 from tensorflow.keras.models import load_model
 
 base_path = os.path.dirname(os.path.dirname(__file__))
 
+# Periodic windows, Hann and Hamming sum to a constant at hops of a half or a quarter frame.
+WINDOWS = {
+    'hann': lambda n: np.hanning(n + 1)[:-1],
+    'hamming': lambda n: np.hamming(n + 1)[:-1],
+    'rect': np.ones,
+}
 
-# Get data.
-def get_audio(filepath):
-    audio_path = os.path.join(base_path, filepath)
-    _, audio = wavfile.read(audio_path)
-    return audio.astype(np.float32)
 
+# Read and write audio.
+class Reader:
+    """16 bit mono samples from a WAV file, or raw PCM from stdin."""
 
-def get_frames(sample, frame_length):
-    frames = [sample[s:s + frame_length] for s in range(0, len(sample) - frame_length, frame_length)]
-    return np.stack(frames)[:, :, np.newaxis]
+    def __init__(self, filepath, sample_rate):
+        if filepath == '-':
+            self.wav = None
+            self.sample_rate = sample_rate
+        else:
+            self.wav = wave.open(os.path.join(base_path, filepath), 'rb')
+            if self.wav.getsampwidth() != 2 or self.wav.getnchannels() != 1:
+                raise ValueError(f'{filepath}: expected 16 bit mono audio')
+            self.sample_rate = self.wav.getframerate()
 
+    def read(self, n):
+        if self.wav is not None:
+            data = self.wav.readframes(n)
+        else:
+            data = sys.stdin.buffer.read(2 * n)
+            data = data[:len(data) // 2 * 2]
+        return np.frombuffer(data, dtype='<i2').astype(np.float32)
 
-# Apply model.
-def apply_model(filepath, sample, frame_length):
+    def close(self):
+        if self.wav is not None:
+            self.wav.close()
+
+
+class Writer:
+    """16 bit mono samples to a WAV file, or raw PCM to stdout."""
+
+    def __init__(self, filepath, sample_rate):
+        if filepath == '-':
+            self.wav = None
+        else:
+            self.wav = wave.open(os.path.join(base_path, filepath), 'wb')
+            self.wav.setnchannels(1)
+            self.wav.setsampwidth(2)
+            self.wav.setframerate(sample_rate)
+
+    def write(self, samples):
+        # The model isn't bounded, past the int16 range samples would wrap around.
+        data = np.clip(np.rint(samples), -32768, 32767).astype('<i2').tobytes()
+        if self.wav is not None:
+            # The header is patched once, on close.
+            self.wav.writeframesraw(data)
+        else:
+            sys.stdout.buffer.write(data)
+
+    def close(self):
+        if self.wav is not None:
+            self.wav.close()
+        else:
+            sys.stdout.buffer.flush()
+
+
+# Load model, as a function from a batch of frames to a batch of frames.
+def keras_model(filepath):
     model_path = os.path.join(base_path, filepath)
     model = load_model(model_path)
 
-    frames = get_frames(sample, frame_length)
-    return model.predict(frames)
+    def predict(frames):
+        out = model.predict_on_batch(frames[:, :, np.newaxis])
+        return np.asarray(out).reshape(len(frames), -1)
+
+    return predict
+
+
+class ConvertedModel:
+    """TFLite interpreter fed `batch_size` frames per invocation, outputs go to a preallocated array."""
+
+    def __init__(self, model_path, frame_length, batch_size=16, num_threads=None):
+        self.interpreter = tf.lite.Interpreter(model_path=model_path, num_threads=num_threads)
+
+        # Get input and output tensors, the input takes a whole batch.
+        self.input_index = self.interpreter.get_input_details()[0]['index']
+        self.output_index = self.interpreter.get_output_details()[0]['index']
+        self.interpreter.resize_tensor_input(self.input_index, [batch_size, frame_length, 1])
+        self.interpreter.allocate_tensors()
+
+        self.batch_size = batch_size
+        self.batch = np.zeros((batch_size, frame_length, 1), dtype=np.float32)
+        self.out = np.empty((batch_size, frame_length), dtype=np.float32)
+
+    def __call__(self, frames):
+        if len(frames) > len(self.out):
+            self.out = np.empty(frames.shape, dtype=np.float32)
+
+        for s in range(0, len(frames), self.batch_size):
+            n = min(self.batch_size, len(frames) - s)
+            # A short last batch is padded, resizing would reallocate the tensors.
+            self.batch[:n, :, 0] = frames[s:s + n]
+            self.batch[n:] = 0
+            self.interpreter.set_tensor(self.input_index, self.batch)
+            self.interpreter.invoke()
+            # A view of the output tensor, valid until the next invoke.
+            self.out[s:s + n] = self.interpreter.tensor(self.output_index)()[:n].reshape(n, -1)
+
+        return self.out[:len(frames)]
+
+
+# Interpreter of a pool worker.
+_model = None
+
 
+def _init_worker(*args):
+    global _model
+    _model = ConvertedModel(*args)
 
-def apply_converted_model(filepath, sample, frame_length):
+
+def _predict_batch(frames):
+    return _model(frames)
+
+
+class ConvertedModelPool:
+    """Batches spread across interpreters in worker processes."""
+
+    def __init__(self, processes, model_path, frame_length, batch_size=16, num_threads=None):
+        self.pool = multiprocessing.Pool(
+            processes, _init_worker, (model_path, frame_length, batch_size, num_threads)
+        )
+        self.batch_size = batch_size
+        self.out = np.empty((batch_size, frame_length), dtype=np.float32)
+
+    def __call__(self, frames):
+        if len(frames) > len(self.out):
+            self.out = np.empty(frames.shape, dtype=np.float32)
+
+        batches = [frames[s:s + self.batch_size] for s in range(0, len(frames), self.batch_size)]
+        return np.concatenate(self.pool.map(_predict_batch, batches), out=self.out[:len(frames)])
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+
+def converted_model(filepath, frame_length, batch_size, num_threads, processes):
     model_path = os.path.join(base_path, filepath)
-    interpreter = tf.lite.Interpreter(model_path=model_path)
-    interpreter.allocate_tensors()
+    if processes > 1:
+        return ConvertedModelPool(processes, model_path, frame_length, batch_size, num_threads)
+    return ConvertedModel(model_path, frame_length, batch_size, num_threads)
 
-    # Get input and output tensors.
-    input_details = interpreter.get_input_details()
-    output_details = interpreter.get_output_details()
 
-    # Infer.
-    frames = get_frames(sample, frame_length)
-    out = []
+# Overlap-add.
+class OverlapAdd:
+    """Runs the model on frames `hop` apart, windows the outputs and sums them up.
 
-    for f in frames:
-        interpreter.set_tensor(input_details[0]['index'], f[np.newaxis, :, :])
-        interpreter.invoke()
-        out.append(interpreter.get_tensor(output_details[0]['index']))
+    Only the frames of the current chunk and one frame of overlap are buffered,
+    memory doesn't grow with the length of the recording.
+    """
 
-    return np.stack(out)
+    def __init__(self, predict, frame_length, hop, window='hann'):
+        if not 0 < hop <= frame_length:
+            raise ValueError(f'hop must be in (0, {frame_length}]')
+        self.predict = predict
+        self.frame_length = frame_length
+        self.hop = hop
 
+        # Scaled so that the overlapping windows sum to one at every sample.
+        w = WINDOWS[window](frame_length).astype(np.float32)
+        total = np.zeros(hop, dtype=np.float32)
+        for start in range(0, frame_length, hop):
+            part = w[start:start + hop]
+            total[:len(part)] += part
+        if not np.all(total > 0):
+            raise ValueError(f'{window} window with hop {hop} leaves samples uncovered')
+        self.window = w / np.resize(total, frame_length)
 
-# TODO: overlap frames? LIMIT VALUES TO [~-30000, ~30000]???
+        # Zeros ahead of the input so that its first samples are covered by as many frames as the rest.
+        self.pending = np.zeros(frame_length - hop, dtype=np.float32)
+        self.overlap = np.zeros(frame_length - hop, dtype=np.float32)
+        self.skip = frame_length - hop
+        self.received = 0
+        self.emitted = 0
 
-def main(args):
-    audio = get_audio(args.input)
+    def process(self, samples):
+        self.received += len(samples)
+        self.pending = np.concatenate([self.pending, samples])
+        return self._run()
 
-    s = time.time()
+    def flush(self):
+        # Zeros after the input so that the tail isn't dropped, output is as long as the input.
+        self.pending = np.concatenate([self.pending, np.zeros(self.frame_length, dtype=np.float32)])
+        return self._run()[:self.received - self.emitted]
+
+    def _run(self):
+        n = (len(self.pending) - self.frame_length) // self.hop + 1
+        if n <= 0:
+            return np.zeros(0, dtype=np.float32)
+
+        # Strided views of the buffer, copied once into the batch.
+        frames = np.lib.stride_tricks.sliding_window_view(self.pending, self.frame_length)[::self.hop][:n]
+        out = self.predict(np.ascontiguousarray(frames)) * self.window
+        self.pending = self.pending[n * self.hop:]
+
+        # Samples before n * hop are complete, the rest waits for the next frames.
+        span = np.zeros((n - 1) * self.hop + self.frame_length, dtype=np.float32)
+        span[:len(self.overlap)] = self.overlap
+        for i, frame in enumerate(out):
+            span[i * self.hop:i * self.hop + self.frame_length] += frame
+        self.overlap = span[n * self.hop:]
+
+        ready = span[:n * self.hop]
+        if self.skip:
+            skipped = min(self.skip, len(ready))
+            ready = ready[skipped:]
+            self.skip -= skipped
+        self.emitted += len(ready)
+        return ready
+
+
+def main(args):
+    hop = args.hop or args.frame_length // 2
     if args.converted:
-        out = apply_converted_model(args.model_path, audio, args.frame_length)
+        predict = converted_model(
+            args.model_path, args.frame_length, args.batch_size, args.num_threads, args.processes
+        )
     else:
-        out = apply_model(args.model_path, audio, args.frame_length)
-    print(time.time() - s)
+        predict = keras_model(args.model_path)
+    engine = OverlapAdd(predict, args.frame_length, hop, args.window)
+    # Enough frames per chunk for a batch in every process.
+    chunk = args.chunk or args.batch_size * hop * args.processes
+
+    reader = Reader(args.input, args.sample_rate)
+    writer = Writer(args.output, reader.sample_rate)
+
+    s = time.perf_counter()
+    try:
+        while True:
+            samples = reader.read(chunk)
+            if not len(samples):
+                break
+            writer.write(engine.process(samples))
+        writer.write(engine.flush())
+    finally:
+        reader.close()
+        writer.close()
+        if isinstance(predict, ConvertedModelPool):
+            predict.close()
+    elapsed = time.perf_counter() - s
 
-    out = out.reshape(-1, 1).astype(np.int16)
-    wavfile.write(args.output, args.sample_rate, out)
+    # Above 1 the engine can't keep up with live audio.
+    duration = engine.received / reader.sample_rate
+    rtf = elapsed / duration if duration else float('nan')
+    print(f'{duration:.1f} s of audio in {elapsed:.1f} s, real-time factor {rtf:.3f}', file=sys.stderr)
 
 
 def parse_args():
     parser = argparse.ArgumentParser()
-    parser.add_argument('--frame_length', default=4096)
-    parser.add_argument('--sample_rate', default=16000)
+    parser.add_argument('--frame_length', type=int, default=4096)
+    parser.add_argument('--hop', type=int, default=None, help='defaults to half a frame')
+    parser.add_argument('--window', choices=sorted(WINDOWS), default='hann')
+    parser.add_argument('--chunk', type=int, default=None, help='samples read at a time, defaults to a batch of hops')
+    parser.add_argument('--sample_rate', type=int, default=16000, help='of raw PCM on stdin')
     parser.add_argument('--converted', action='store_true')
+    parser.add_argument('--batch_size', type=int, default=16, help='frames per TFLite invocation')
+    parser.add_argument('--num_threads', type=int, default=None, help='of each TFLite interpreter')
+    parser.add_argument('--processes', type=int, default=1, help='TFLite interpreters run in parallel')
     parser.add_argument('model_path')
-    parser.add_argument('input')
-    parser.add_argument('output')
+    parser.add_argument('input', help="WAV file, or '-' for stdin")
+    parser.add_argument('output', help="WAV file, or '-' for stdout")
     return parser.parse_args()
 
 
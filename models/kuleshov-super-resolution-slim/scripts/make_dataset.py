@@ -0,0 +1,53 @@
+# Frame clean recordings and their codec-degraded copies into training shards.
+#   python scripts/make_dataset.py './speaker_27/27-*.wav' dataset_27 --bitrate 6
+# Degraded copies are named <bitrate>-<clean name>, as written by data/apply_opus.sh.
+import argparse
+import glob
+import os
+
+from ausupre import dataset
+
+base_path = os.path.dirname(os.path.dirname(__file__))
+
+
+def get_pairs(pattern, degraded_dir, bitrate):
+    pairs, missing = [], []
+    for clean_path in sorted(glob.glob(os.path.join(base_path, pattern), recursive=True)):
+        directory, name = os.path.split(clean_path)
+        degraded_path = os.path.join(degraded_dir or directory, f'{bitrate}-{name}')
+        if os.path.exists(degraded_path):
+            pairs.append((clean_path, degraded_path))
+        else:
+            missing.append(clean_path)
+
+    # Checked before anything is written, not half way through the corpus.
+    if missing:
+        raise FileNotFoundError(f'No {bitrate}-* degraded copy of {len(missing)} files: ' + ', '.join(missing[:10]))
+    return pairs
+
+
+def main(args):
+    degraded_dir = os.path.join(base_path, args.degraded_dir) if args.degraded_dir else None
+    pairs = get_pairs(args.pattern, degraded_dir, args.bitrate)
+    output_dir = os.path.join(base_path, args.output)
+    shards, frames = dataset.build(
+        pairs, output_dir, args.frame_length, args.step or args.frame_length // 2, args.shard_size
+    )
+    print(f'{frames} frames in {shards} shards written to {output_dir}')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('pattern', help='glob of clean WAV files')
+    parser.add_argument('output')
+    parser.add_argument('--degraded_dir', default=None, help='defaults to the directory of each clean file')
+    parser.add_argument('--bitrate', default='6')
+    parser.add_argument('--frame_length', type=int, default=512)
+    parser.add_argument('--step', type=int, default=None, help='defaults to half a frame')
+    parser.add_argument('--shard_size', type=int, default=8192, help='frames per shard')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    arguments = parse_args()
+    main(arguments)
@@ -1,56 +1,46 @@
-import glob
-import numpy as np
+import argparse
 import os
-from scipy.io import wavfile
 from tensorflow.keras import callbacks, optimizers
 
-from ausupre import models
+from ausupre import dataset, models
 
+base_path = os.path.dirname(os.path.dirname(__file__))
 
-# Prepare training data.
-def split_sample(sample, frame_length):
-    step = frame_length // 2
-    return [sample[s:s + frame_length] for s in range(0, len(sample) - frame_length, step)]
 
+def main(args):
+    # Training data, shards written by scripts/make_dataset.py and read through memory maps.
+    train = dataset.FrameSequence(os.path.join(base_path, args.dataset), batch_size=args.batch_size)
 
-tmp_frame_length = 512
-original_files = glob.glob('./speaker_27/27-*.wav')
-compressed = [f.replace('/27', '/6-27') for f in original_files]
+    # Train the model.
+    checkpoint_path = os.path.join(base_path, args.checkpoint)
 
-original_arrays = [wavfile.read(f)[1] for f in original_files]
-compressed_arrays = [wavfile.read(f)[1] for f in compressed]
+    # Create a callback that saves the model's weights
+    cp_callback = callbacks.ModelCheckpoint(filepath=checkpoint_path,
+                                            save_weights_only=True,
+                                            verbose=1)
 
-x_train_list = []
-y_train_list = []
+    # Frames are as long as the dataset was built with.
+    model = models.build_model(train.frame_length, 3)
+    model.compile(optimizer=optimizers.Adam(clipvalue=1.),
+                  loss='mean_squared_error')
 
-for o_arr, c_arr in zip(original_arrays, compressed_arrays):
-    x_samples = split_sample(o_arr, tmp_frame_length)
-    y_samples = split_sample(c_arr, tmp_frame_length)
-    x_train_list.extend(x_samples)
-    y_train_list.extend(y_samples)
+    history = model.fit(train,
+                        epochs=args.epochs,
+                        validation_data=train,
+                        callbacks=[cp_callback])
 
-x_train = np.stack(x_train_list)
-y_train = np.stack(y_train_list)
+    print(history)
 
 
-# Train the model.
-checkpoint_path = "training_3/cp.ckpt"
-checkpoint_dir = os.path.dirname(checkpoint_path)
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('dataset', help='directory of shards')
+    parser.add_argument('--checkpoint', default='training_3/cp.ckpt')
+    parser.add_argument('--batch_size', type=int, default=128)
+    parser.add_argument('--epochs', type=int, default=100)
+    return parser.parse_args()
 
-# Create a callback that saves the model's weights
-cp_callback = callbacks.ModelCheckpoint(filepath=checkpoint_path,
-                                        save_weights_only=True,
-                                        verbose=1)
 
-model = models.build_model(tmp_frame_length, 3)
-model.compile(optimizer=optimizers.Adam(clipvalue=1.),
-              loss='mean_squared_error')
-
-history = model.fit(x_train,
-                    y_train,
-                    batch_size=128,
-                    epochs=100,
-                    validation_data=(x_train, y_train),
-                    callbacks=[cp_callback])
-
-print(history)
+if __name__ == '__main__':
+    arguments = parse_args()
+    main(arguments)
@@ -1,40 +1,174 @@
 #!/usr/bin/env python
+# Single user:  ./add_user.py login password
+# Bulk:         ./add_user.py --bulk users.csv   (CSV with a login,password header, or .jsonl, - for stdin)
 import argparse
+import csv
+import io
+import json
+import os
+import sys
+import time
 import bcrypt
 import psycopg2
+from concurrent.futures import ProcessPoolExecutor
 from configparser import ConfigParser
 from contextlib import contextmanager
+from itertools import islice, repeat
 
 i_query = 'INSERT INTO users(login, password) VALUES(%s, %s)'
 
+# Rows are COPYed into a staging table first, so conflicts can be skipped on the way into users.
+create_staging = ('CREATE TEMP TABLE IF NOT EXISTS staging_users('
+                  'login VARCHAR (100), '
+                  'password VARCHAR (100)) ON COMMIT DELETE ROWS;')
+copy_query = 'COPY staging_users (login, password) FROM STDIN WITH (FORMAT csv)'
+merge_query = ('INSERT INTO users(login, password) '
+               'SELECT DISTINCT ON (login) login, password FROM staging_users '
+               'ON CONFLICT (login) DO NOTHING')
+existing_query = 'SELECT login FROM users WHERE login = ANY(%s)'
 
-@contextmanager
-def get_connection():
+
+def get_config():
     parser = ConfigParser()
     parser.read('config.ini')
-    connection = psycopg2.connect(parser.get('DATABASE', 'URL'))
+    return parser
+
+
+@contextmanager
+def get_connection():
+    connection = psycopg2.connect(get_config().get('DATABASE', 'URL'))
     try:
         yield connection
     finally:
         connection.close()
 
 
+def hash_password(password, cost):
+    return bcrypt.hashpw(password.encode(), bcrypt.gensalt(cost)).decode()
+
+
 def add_user(login, password):
     with get_connection() as conn:
         with conn.cursor() as cur:
-            hashed = bcrypt.hashpw(password.encode(), bcrypt.gensalt(12))
-            cur.execute(i_query, (login, hashed.decode()))
+            cost = get_config().getint('AUTH', 'BCRYPT COST', fallback=12)
+            cur.execute(i_query, (login, hash_password(password, cost)))
             conn.commit()
 
 
+def read_users(path):
+    f = sys.stdin if path == '-' else open(path, newline='')
+    try:
+        if path.endswith('.jsonl'):
+            for line in f:
+                if line.strip():
+                    user = json.loads(line)
+                    yield user['login'], user['password']
+        else:
+            for row in csv.DictReader(f):
+                yield row['login'], row['password']
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+def batches(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def skip_existing(conn, batch):
+    # Makes reruns cheap: users inserted by an interrupted run are not hashed again.
+    with conn.cursor() as cur:
+        cur.execute(existing_query, ([login for login, _ in batch],))
+        existing = {row[0] for row in cur.fetchall()}
+    conn.commit()
+    return [(login, password) for login, password in batch if login not in existing]
+
+
+def copy_batch(conn, logins, hashes):
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(zip(logins, hashes))
+    buffer.seek(0)
+
+    with conn.cursor() as cur:
+        cur.copy_expert(copy_query, buffer)
+        cur.execute(merge_query)
+        inserted = cur.rowcount
+    # One transaction per batch, an interrupted run loses at most the batch in flight.
+    conn.commit()
+    return inserted
+
+
+class Progress:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.read = 0
+        self.hashed = 0
+        self.inserted = 0
+
+    def report(self):
+        elapsed = time.perf_counter() - self.start
+        print(f'{self.read} read, {self.hashed} hashed, {self.inserted} inserted, '
+              f'{self.read - self.inserted} skipped, {self.read / elapsed:.0f} users/s', file=sys.stderr)
+
+
+def add_users(path, batch_size, workers):
+    cost = get_config().getint('AUTH', 'BCRYPT COST', fallback=12)
+    progress = Progress()
+
+    with get_connection() as conn, ProcessPoolExecutor(workers) as pool:
+        with conn.cursor() as cur:
+            cur.execute(create_staging)
+        conn.commit()
+
+        # Hashing of the next batch overlaps with the COPY of the previous one.
+        pending = None
+        chunksize = max(1, batch_size // (workers * 4))
+        for batch in batches(read_users(path), batch_size):
+            fresh = skip_existing(conn, batch)
+            hashes = pool.map(hash_password, [p for _, p in fresh], repeat(cost), chunksize=chunksize)
+
+            if pending is not None:
+                flush(conn, progress, *pending)
+            pending = (len(batch), [login for login, _ in fresh], hashes)
+
+        if pending is not None:
+            flush(conn, progress, *pending)
+
+    progress.report()
+
+
+def flush(conn, progress, read, logins, hashes):
+    hashes = list(hashes)
+    progress.read += read
+    progress.hashed += len(hashes)
+    if logins:
+        progress.inserted += copy_batch(conn, logins, hashes)
+    progress.report()
+
+
 def parse_args():
     parser = argparse.ArgumentParser()
-    parser.add_argument('login', default='user')
-    parser.add_argument('password', default='password')
-    return parser.parse_args()
+    parser.add_argument('login', nargs='?')
+    parser.add_argument('password', nargs='?')
+    parser.add_argument('--bulk', metavar='PATH', help='CSV or JSONL file of users, - for CSV on stdin')
+    parser.add_argument('--batch_size', type=int, default=1000)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    # Optional only for bulk imports.
+    if not args.bulk and (args.login is None or args.password is None):
+        parser.error('login and password are required unless --bulk is given')
+    return args
 
 
 if __name__ == '__main__':
     args = parse_args()
-    add_user(args.login, args.password)
-
+    if args.bulk:
+        add_users(args.bulk, args.batch_size, args.workers)
+    else:
+        add_user(args.login, args.password)
@@ -1,46 +1,200 @@
+import asyncio
 import base64
 import bcrypt
 import fernet
+import logging
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from aiohttp_security import SessionIdentityPolicy, setup as setup_security
 from aiohttp_security.abc import AbstractAuthorizationPolicy
-from aiohttp_session import setup as setup_session
+from aiohttp_session import get_session, setup as setup_session
 from aiohttp_session.cookie_storage import EncryptedCookieStorage
 
+from server.metrics import Counter, Histogram
+
+LOGIN_LATENCY = Histogram('deepnoise_login_seconds', 'Credential check time, including pool wait.')
+LOGIN_FAILURES = Counter('deepnoise_login_failures_total', 'Rejected logins.')
+LOGIN_WAIT = Histogram('deepnoise_login_wait_seconds', 'Time a credential check waits for a hashing slot.')
+LOGIN_REHASHED = Counter('deepnoise_login_rehashed_total', 'Password hashes upgraded to the configured cost.')
+
+
+class Claim(str):
+    """Session identity along with the time it was issued at (on successful login)."""
+
+    def __new__(cls, identity, issued):
+        claim = super().__new__(cls, identity)
+        claim.issued = issued
+        return claim
+
+
+class ClaimIdentityPolicy(SessionIdentityPolicy):
+    # Session cookies are encrypted and authenticated, so a fresh claim proves a past login.
+    issued_key = 'AIOHTTP_SECURITY_ISSUED'
+
+    async def identify(self, request):
+        identity = await super().identify(request)
+        if identity is None:
+            return None
+
+        session = await get_session(request)
+        return Claim(identity, session.get(self.issued_key, 0))
+
+    async def remember(self, request, response, identity, **kwargs):
+        await super().remember(request, response, identity, **kwargs)
+        session = await get_session(request)
+        session[self.issued_key] = int(time.time())
+
+    async def forget(self, request, response):
+        await super().forget(request, response)
+        session = await get_session(request)
+        session.pop(self.issued_key, None)
+
+
+class IdentityCache:
+    """Registered logins seen recently, so authorization needs no query on the hot path."""
+
+    def __init__(self, ttl=300, max_size=100000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries = OrderedDict()
+
+    def known(self, login):
+        expires = self.entries.get(login, None)
+        if expires is None:
+            return False
+        if expires < time.monotonic():
+            del self.entries[login]
+            return False
+        return True
+
+    def add(self, login):
+        self.entries[login] = time.monotonic() + self.ttl
+        self.entries.move_to_end(login)
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, login):
+        self.entries.pop(login, None)
+
 
 class DBAuthorizationPolicy(AbstractAuthorizationPolicy):
-    def __init__(self, storage):
+    def __init__(self, storage, cache, claim_ttl=0):
         self.storage = storage
+        self.cache = cache
+        self.claim_ttl = claim_ttl
 
     async def authorized_userid(self, identity):
-        registered = await self.storage.registered(identity)
-        if registered:
-            return identity
+        if await self.registered(identity):
+            return str(identity)
         else:
             return None
 
     async def permits(self, identity, permission, context=None):
         if identity is None:
             return False
-        registered = await self.storage.registered(identity)  # none are privileged o.O
+        return await self.registered(identity)  # none are privileged o.O
+
+    async def registered(self, identity):
+        if isinstance(identity, Claim) and time.time() - identity.issued < self.claim_ttl:
+            return True
+
+        if self.cache.known(identity):
+            return True
+
+        registered = await self.storage.registered(identity)
+        if registered:
+            self.cache.add(str(identity))
         return registered
 
 
-async def check_credentials(storage, username, password):
-    password_hash = await storage.get_hash(username)
+def hash_cost(password_hash):
+    # $2b$<cost>$<salt + hash>
+    return int(password_hash.split(b'$')[2])
 
-    if password_hash:
-        if bcrypt.checkpw(password.encode(), password_hash.encode()):
-            return True
 
-    return False
+def verify_password(password, password_hash, cost):
+    # Runs in a pool process, returns a new hash if the configured cost changed.
+    if not bcrypt.checkpw(password, password_hash):
+        return False, None
+
+    if hash_cost(password_hash) != cost:
+        return True, bcrypt.hashpw(password, bcrypt.gensalt(cost)).decode()
+    return True, None
+
+
+class PasswordVerifier:
+    """Checks bcrypt hashes in a process pool so logins don't stall the event loop."""
+
+    def __init__(self, workers=2, max_concurrent=8, cost=12):
+        self.workers = workers
+        self.cost = cost
+        self.slots = asyncio.Semaphore(max_concurrent)
+        self.executor = None
+
+    def start(self):
+        self.executor = ProcessPoolExecutor(max_workers=self.workers)
 
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+    async def check_credentials(self, storage, username, password):
+        start = time.perf_counter()
+
+        password_hash = await storage.get_hash(username)
+        if not password_hash:
+            LOGIN_FAILURES.inc()
+            return False
+
+        loop = asyncio.get_running_loop()
+        queued = time.perf_counter()
+        async with self.slots:
+            LOGIN_WAIT.observe(time.perf_counter() - queued)
+            valid, new_hash = await loop.run_in_executor(
+                self.executor, verify_password, password.encode(), password_hash.encode(), self.cost
+            )
+
+        if new_hash is not None:
+            await storage.set_hash(username, new_hash)
+            LOGIN_REHASHED.inc()
+            logging.info('Password of %s rehashed with cost %d', username, self.cost)
+
+        if not valid:
+            LOGIN_FAILURES.inc()
+        LOGIN_LATENCY.observe(time.perf_counter() - start)
+        return valid
+
+
+def setup_auth(app, config):
+    verifier = PasswordVerifier(
+        workers=config.getint('AUTH', 'WORKERS', fallback=2),
+        max_concurrent=config.getint('AUTH', 'MAX CONCURRENT', fallback=8),
+        cost=config.getint('AUTH', 'BCRYPT COST', fallback=12),
+    )
+    app['passwords'] = verifier
+
+    identities = IdentityCache(
+        ttl=config.getfloat('AUTH', 'IDENTITY TTL', fallback=300),
+        max_size=config.getint('AUTH', 'IDENTITY CACHE SIZE', fallback=100000),
+    )
+    app['identities'] = identities
 
-def setup_auth(app):
     async def _setup(app):
-        # Setup session storage.
-        fernet_key = fernet.Fernet.generate_key()
+        verifier.start()
+
+        # Setup session storage, the key has to be shared by all workers.
+        fernet_key = config.get('AUTH', 'SECRET KEY', fallback=None) or fernet.Fernet.generate_key()
         secret_key = base64.urlsafe_b64decode(fernet_key)
         setup_session(app, EncryptedCookieStorage(secret_key))
 
-        setup_security(app, SessionIdentityPolicy(), DBAuthorizationPolicy(app['storage']))
+        policy = DBAuthorizationPolicy(
+            app['storage'], identities,
+            claim_ttl=config.getfloat('AUTH', 'CLAIM TTL', fallback=0)
+        )
+        setup_security(app, ClaimIdentityPolicy(), policy)
+
+    async def _cleanup(app):
+        verifier.close()
+
     app.on_startup.append(_setup)
+    app.on_cleanup.append(_cleanup)
@@ -0,0 +1,202 @@
+import asyncio
+import json
+import logging
+import os
+
+# SDP offers easily exceed the default 64 KiB line limit of asyncio streams.
+FRAME_LIMIT = 2 ** 20
+
+
+class MessageBus:
+    """Routes signalling messages to clients connected to other workers."""
+
+    def __init__(self):
+        self.handler = None
+        self.bounce = None
+
+    async def start(self, handler, bounce=None):
+        # `bounce` gets messages sent to a nick no worker serves.
+        self.handler = handler
+        self.bounce = bounce
+
+    async def close(self):
+        pass
+
+    def reachable(self, nick):
+        raise NotImplementedError
+
+    async def register(self, nick):
+        raise NotImplementedError
+
+    async def unregister(self, nick):
+        raise NotImplementedError
+
+    async def send(self, nick, type, payload):
+        raise NotImplementedError
+
+    async def deliver(self, nick, type, payload):
+        if self.handler is None:
+            logging.error('Bus message %s for %s before start', type, nick)
+            return
+        await self.handler(nick, type, payload)
+
+    async def undeliverable(self, nick, type, payload):
+        if self.bounce is not None:
+            await self.bounce(nick, type, payload)
+
+
+class LocalBroker:
+    """In-process stand-in for the hub, shared by all buses of one process."""
+
+    def __init__(self):
+        self.routes = {}
+
+
+class LocalBus(MessageBus):
+    def __init__(self, broker=None):
+        super().__init__()
+        self.broker = broker if broker is not None else LocalBroker()
+
+    def reachable(self, nick):
+        return nick in self.broker.routes
+
+    async def register(self, nick):
+        self.broker.routes[nick] = self
+
+    async def unregister(self, nick):
+        if self.broker.routes.get(nick) is self:
+            del self.broker.routes[nick]
+
+    async def send(self, nick, type, payload):
+        bus = self.broker.routes.get(nick, None)
+        if bus is None:
+            logging.error('Bus: no route to %s for %s', nick, type)
+            await self.undeliverable(nick, type, payload)
+            return False
+
+        await bus.deliver(nick, type, payload)
+        return True
+
+
+class UnixBus(MessageBus):
+    """Worker side of the Unix socket hub (see `BusHub`)."""
+
+    def __init__(self, path, retries=50, retry_delay=0.1):
+        super().__init__()
+        self.path = path
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.reader = None
+        self.writer = None
+        self.receiver = None
+
+    async def start(self, handler, bounce=None):
+        await super().start(handler, bounce)
+
+        # The hub is started alongside the workers, give it a moment.
+        for attempt in range(self.retries):
+            try:
+                self.reader, self.writer = await asyncio.open_unix_connection(self.path, limit=FRAME_LIMIT)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                if attempt == self.retries - 1:
+                    raise
+                await asyncio.sleep(self.retry_delay)
+
+        self.receiver = asyncio.create_task(self._receive())
+
+    async def close(self):
+        if self.receiver is not None:
+            self.receiver.cancel()
+        if self.writer is not None:
+            self.writer.close()
+
+    def reachable(self, nick):
+        # Only the hub knows, undeliverable messages are dropped there.
+        return True
+
+    async def register(self, nick):
+        await self._write({'op': 'register', 'nick': nick})
+
+    async def unregister(self, nick):
+        await self._write({'op': 'unregister', 'nick': nick})
+
+    async def send(self, nick, type, payload):
+        await self._write({'op': 'send', 'to': nick, 'type': type, 'payload': payload})
+        return True
+
+    async def _write(self, frame):
+        self.writer.write(json.dumps(frame).encode() + b'\n')
+        await self.writer.drain()
+
+    async def _receive(self):
+        async for line in self.reader:
+            frame = json.loads(line)
+            try:
+                if frame['op'] == 'bounce':
+                    await self.undeliverable(frame['to'], frame['type'], frame['payload'])
+                else:
+                    await self.deliver(frame['to'], frame['type'], frame['payload'])
+            except Exception as e:
+                logging.error('Bus delivery of %s to %s failed: %r', frame['type'], frame['to'], e)
+
+        logging.error('Bus: hub connection lost')
+
+
+class BusHub:
+    """Keeps track of which worker serves which nick and forwards frames to it."""
+
+    def __init__(self, path):
+        self.path = path
+        self.routes = {}
+
+    async def serve(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+        server = await asyncio.start_unix_server(self.on_worker, path=self.path, limit=FRAME_LIMIT)
+        logging.info('Bus hub listening on %s', self.path)
+        async with server:
+            await server.serve_forever()
+
+    async def on_worker(self, reader, writer):
+        nicks = set()
+        try:
+            async for line in reader:
+                frame = json.loads(line)
+                op = frame['op']
+
+                if op == 'send':
+                    target = self.routes.get(frame['to'], None)
+                    if target is None:
+                        logging.error('Hub: no route to %s for %s', frame['to'], frame['type'])
+                        # Returned to the sender, which may be waiting on an answer that won't come.
+                        frame['op'] = 'bounce'
+                        writer.write(json.dumps(frame).encode() + b'\n')
+                        await writer.drain()
+                        continue
+                    # Workers read the same frame format, forward it untouched.
+                    target.write(line)
+                    await target.drain()
+
+                elif op == 'register':
+                    self.routes[frame['nick']] = writer
+                    nicks.add(frame['nick'])
+
+                elif op == 'unregister':
+                    if self.routes.get(frame['nick']) is writer:
+                        del self.routes[frame['nick']]
+                    nicks.discard(frame['nick'])
+
+        except ConnectionError as e:
+            logging.error('Hub: worker connection lost: %r', e)
+        finally:
+            for nick in nicks:
+                if self.routes.get(nick) is writer:
+                    del self.routes[nick]
+            writer.close()
+
+
+def run_hub(path):
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(BusHub(path).serve())
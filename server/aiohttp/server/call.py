@@ -1,79 +1,335 @@
-import json
+import asyncio
 import logging
+import time
 import uuid
+from aiohttp import WSCloseCode
 from collections import defaultdict
-from server.notifications import push_incoming_call
+from server.bus import LocalBus
+from server.envelope import LEGACY
+from server.metrics import Gauge, Histogram
+from server.outbox import Outbox
+from server.presence import FRIEND_ADDED, PRESENCE, PROBE, Presence
+from server import records
+from server.timers import TimerWheel
+from server.tokens import TokenCache
+
+DISPATCH_LATENCY = Histogram(
+    'deepnoise_dispatch_seconds', 'Time spent handling a client message.', ['state', 'type']
+)
+CALL_SETUP_LATENCY = Histogram(
+    'deepnoise_call_setup_seconds', 'Time from CALL to ACCEPTED and to the first ICE candidate.', ['stage']
+)
+CLIENTS = Gauge('deepnoise_clients', 'Logged in clients.')
+CALLS = Gauge('deepnoise_calls', 'Calls known to the server.')
+RENDEZVOUS = Gauge('deepnoise_rendezvous', 'Callers waiting for the callee to answer.')
 
 
 class Server:
-    def __init__(self, storage):
+    def __init__(self, storage, notifications, bus=None, tokens=None, ring_timeout=45, signalling_timeout=30,
+                 recorder=None, friends=None):
         self.clients = {}
-        self.tokens = {}
+        self.tokens = tokens if tokens is not None else TokenCache(storage)
         self.storage = storage
+        self.notifications = notifications
         self.calls = {}
         self.cancelled = defaultdict(set)
+        self.bus = bus if bus is not None else LocalBus()
+        # Passed to each client's Outbox.
+        self.outbox_options = {}
 
-    async def setup(self):
-        user_tokens = await self.storage.get_tokens()
-        for entry in user_tokens:
-            self.tokens[entry[0]] = entry[1]
+        # Calls not answered, or answered but never negotiated, are reaped.
+        self.wheel = TimerWheel()
+        self.ring_timeout = ring_timeout
+        self.signalling_timeout = signalling_timeout
+
+        # Call detail records, written behind.
+        self.recorder = recorder
+
+        # Friend list and online/offline deltas for subscribed clients.
+        self.presence = Presence(self, friends) if friends is not None else None
 
-    def add_client(self, client):
+        # Set on graceful shutdown, calls are kept for the next process.
+        self.draining = False
+        # Calls restored from that process: nick -> (conversation, state), until the client logs in again.
+        self.restored = {}
+
+    async def setup(self):
+        self.notifications.invalid_token_listeners.append(self.on_invalid_token)
+        await self.bus.start(self.on_bus_message, self.on_bus_bounce)
+        self.wheel.start()
+        if self.recorder is not None:
+            await self.recorder.start()
+        if self.presence is not None:
+            self.presence.friends.listeners.append(self.presence.on_friendship)
+
+    async def close(self):
+        self.wheel.stop()
+        await self.bus.close()
+
+    async def add_client(self, client):
         if client.nick not in self.clients:
             self.clients[client.nick] = client
+            await self.bus.register(client.nick)
+            if self.presence is not None:
+                await self.presence.on_online(client.nick)
         else:
             # TODO: handle error (possible?)
-            logging.error(f'Duplicate user nick: {client.nick}')
+            logging.error('Duplicate user nick: %s', client.nick)
 
-    def rm_client(self, client):
+    async def rm_client(self, client):
         if client.nick in self.clients:
             del self.clients[client.nick]
+            await self.bus.unregister(client.nick)
+            if self.presence is not None and not self.draining:
+                await self.presence.on_offline(client.nick)
         else:
             # TODO: handle error (possible?)
-            logging.error(f'No user to delete: {client.nick}')
+            logging.error('No user to delete: %s', client.nick)
 
     # TODO: property getters?
     def get_endpoint(self, nick):
-        # TODO: handle error
-        return self.clients.get(nick, None)
+        endpoint = self.clients.get(nick, None)
+        if endpoint is None and self.bus.reachable(nick):
+            # Connected to another worker.
+            return RemoteEndpoint(nick, self.bus)
+        return endpoint
 
-    def get_token(self, nick):
+    async def get_token(self, nick):
         # TODO: handle error
-        return self.tokens.get(nick, None)
+        return await self.tokens.get(nick)
 
     def get_call(self, call_id):
         # TODO: handle error
         return self.calls.get(call_id, None)
 
     async def on_token(self, identity, token):
-        self.tokens[identity] = token  # TODO: DB
-        await self.storage.add_token(identity, token)
-        logging.info(f'Token saved for user {identity}')
+        await self.tokens.set(identity, token)
+        logging.info('Token saved for user %s', identity)
+
+    async def on_invalid_token(self, token):
+        self.tokens.drop(token)
 
     async def initiate_call(self, caller, callee):
-        token = self.tokens.get(callee, None)
+        token = await self.tokens.get(callee)
         if token:
-            call_id = str(uuid.uuid4())  # TODO: tb replaced by DB id (quality rating, duration etc.)
+            # Also the key of the call record, generated here so that CALL needs no DB round trip.
+            call_id = str(uuid.uuid4())
             conversation = Conversation(call_id)
+            conversation.caller = caller
+            conversation.callee = callee
+            conversation.started = time.monotonic()
             self.calls[call_id] = conversation
+            self.set_timer(conversation, self.ring_timeout, self.on_ring_timeout)
 
-            await push_incoming_call(token, caller, call_id)
+            self.notifications.push_incoming_call(token, caller, call_id)
             return conversation
 
-    async def end_call(self, call_id):
+    async def end_call(self, call_id, reason=records.HANGUP):
         call = self.calls.get(call_id, None)
         if call is not None:
+            self.set_timer(call)
             del self.calls[call_id]
+            # Mirrors of calls hosted by other workers aren't recorded twice.
+            if self.recorder is not None and call.started is not None:
+                self.recorder.record(call, reason)
         else:
             # TODO: throw?
-            logging.error(f'Tried to end non-existent call {call_id}')
+            logging.error('Tried to end non-existent call %s', call_id)
+
+    def mirror_call(self, call_id, caller_endpoint):
+        # The call itself lives on the caller's worker, this is its local view.
+        conversation = Conversation(call_id)
+        conversation.caller = caller_endpoint.nick
+        conversation.join(caller_endpoint)
+        self.calls[call_id] = conversation
+        self.set_timer(conversation, self.signalling_timeout, self.on_signalling_timeout)
+        return conversation
+
+    def set_timer(self, conversation, delay=None, callback=None):
+        # A call has at most one pending timeout, setting one replaces the previous.
+        if conversation.timer is not None:
+            conversation.timer.cancel()
+        conversation.timer = self.wheel.schedule(delay, callback, conversation) if callback else None
+
+    async def on_ring_timeout(self, conversation):
+        if self.calls.get(conversation.uid) is not conversation:
+            return
+
+        logging.info('Call %s not answered in time', conversation.uid)
+        caller = self.clients.get(conversation.caller, None)
+        if caller is not None and caller.conversation is conversation:
+            await caller.on_cancelled_call(conversation.uid, records.NO_ANSWER)
+        else:
+            await self.end_call(conversation.uid, records.NO_ANSWER)
+
+    async def on_signalling_timeout(self, conversation):
+        if self.calls.get(conversation.uid) is not conversation:
+            return
+
+        logging.info('Call %s not negotiated in time', conversation.uid)
+        await self.hang_up_all(conversation, records.SIGNALLING_TIMEOUT)
+
+    async def hang_up_all(self, conversation, reason):
+        nicks = list(conversation.endpoints)
+        for endpoint in list(conversation.endpoints.values()):
+            # Other workers reap their own view of the call.
+            if isinstance(endpoint, RemoteEndpoint):
+                continue
+
+            peer = next((n for n in nicks if n != endpoint.nick), None)
+            endpoint.conversation = None
+            endpoint.state = ClientEndpoint.LOGGED_IN
+            await endpoint.send_msg(ClientEndpoint.HUNG_UP, {'from': peer, 'call_id': conversation.uid})
+
+        await self.end_call(conversation.uid, reason)
+
+    def snapshot(self):
+        # Calls hosted here with the state of their local parties, times as wall clock.
+        offset = time.time() - time.monotonic()
+        participants = defaultdict(dict)
+        for nick, endpoint in self.clients.items():
+            if endpoint.conversation is not None:
+                participants[endpoint.conversation.uid][nick] = endpoint.state.name
+
+        calls = []
+        for uid, conversation in self.calls.items():
+            if conversation.started is None:
+                continue
+
+            timeout = None
+            if conversation.timer is not None and not conversation.timer.cancelled:
+                timeout = 'ring' if conversation.timer.callback == self.on_ring_timeout else 'signalling'
+            calls.append({
+                'call_id': uid,
+                'caller': conversation.caller,
+                'callee': conversation.callee,
+                'started': conversation.started + offset,
+                'answered': conversation.answered + offset if conversation.answered is not None else None,
+                'first_ice': conversation.first_ice,
+                'timeout': timeout,
+                'participants': participants[uid],
+            })
+        return calls
+
+    def restore(self, calls, timeout):
+        offset = time.time() - time.monotonic()
+        states = {s.name: s for s in (ClientEndpoint.LOGGED_IN, ClientEndpoint.RENDEZVOUS, ClientEndpoint.SIGNALLING)}
+
+        for call in calls:
+            conversation = Conversation(call['call_id'])
+            conversation.caller = call['caller']
+            conversation.callee = call['callee']
+            conversation.started = call['started'] - offset
+            conversation.answered = call['answered'] - offset if call['answered'] is not None else None
+            conversation.first_ice = call['first_ice']
+            self.calls[conversation.uid] = conversation
+
+            for nick, state in call['participants'].items():
+                self.restored[nick] = (conversation, states[state])
+            # Parties get `timeout` to come back, then the call carries on under its own timeout.
+            conversation.timer = self.wheel.schedule(timeout, self.on_restore_timeout, conversation, call['timeout'])
+
+    def resume(self, endpoint):
+        # Reattach a client logging in again to the call it was in before the restart.
+        conversation, state = self.restored.pop(endpoint.nick, (None, None))
+        if conversation is None or self.calls.get(conversation.uid) is not conversation:
+            return
+
+        endpoint.conversation = conversation
+        endpoint.state = state
+        if state is ClientEndpoint.SIGNALLING:
+            conversation.join(endpoint)
+        logging.info('Call %s resumed by %s', conversation.uid, endpoint.nick)
+
+    async def on_restore_timeout(self, conversation, timeout):
+        if self.calls.get(conversation.uid) is not conversation:
+            return
+
+        missing = [nick for nick, (c, _) in self.restored.items() if c is conversation]
+        for nick in missing:
+            del self.restored[nick]
+
+        if not missing:
+            conversation.timer = None
+            if timeout == 'ring':
+                self.set_timer(conversation, self.ring_timeout, self.on_ring_timeout)
+            elif timeout == 'signalling':
+                self.set_timer(conversation, self.signalling_timeout, self.on_signalling_timeout)
+            return
+
+        logging.info('Call %s: %s did not come back after restart', conversation.uid, missing)
+        await self.hang_up_all(conversation, records.HANGUP)
+
+    async def on_bus_message(self, nick, type, payload):
+        endpoint = self.clients.get(nick, None)
+
+        if type == ClientEndpoint.ACCEPTED:
+            callee, call_id = payload['callee'], payload['call_id']
+            conversation = endpoint.conversation if endpoint else None
+            if conversation is None or conversation.uid != call_id or endpoint.state != ClientEndpoint.RENDEZVOUS:
+                # Cancelled in the meantime, let the callee's worker drop its view of the call.
+                await self.bus.send(callee, ClientEndpoint.CANCELLED, {'call_id': call_id})
+                return
+
+            conversation.join(RemoteEndpoint(callee, self.bus))
+            await endpoint.on_accepted_call(callee, call_id)
+            return
+
+        if type in (PRESENCE, FRIEND_ADDED, PROBE):
+            # Not an error, presence may cross a disconnect.
+            if endpoint is None or self.presence is None:
+                return
+            if type == PROBE:
+                await self.presence.on_probe(endpoint, payload['from'])
+            else:
+                await self.presence.deliver(endpoint, type, payload)
+            return
+
+        if endpoint is None:
+            logging.error('Bus: %s for %s who is no longer connected', type, nick)
+            return
+
+        if type == ClientEndpoint.REFUSED:
+            await endpoint.on_refused_call(payload['callee'], payload['call_id'])
+        elif type == ClientEndpoint.CANCELLED:
+            await endpoint.on_cancelled_call(payload['call_id'])
+        elif type == ClientEndpoint.ANSWER:
+            if endpoint.conversation is not None:
+                self.set_timer(endpoint.conversation)
+            await endpoint.send_msg(type, payload)
+        elif type == ClientEndpoint.HUNG_UP:
+            conversation = self.calls.get(payload['call_id'], None)
+            if conversation is not None:
+                conversation.endpoints.pop(payload['from'], None)
+            await endpoint.send_msg(type, payload)
+        else:
+            await endpoint.send_msg(type, payload)
+
+
+    async def on_bus_bounce(self, nick, type, payload):
+        if type == ClientEndpoint.ACCEPTED:
+            # The caller is gone, the callee would otherwise wait for the signalling timeout.
+            endpoint = self.clients.get(payload['callee'], None)
+            if endpoint is not None:
+                await endpoint.on_cancelled_call(payload['call_id'])
 
 
 class Conversation:
+    __slots__ = ('uid', 'endpoints', 'caller', 'timer', 'callee', 'started', 'answered', 'first_ice')
+
     def __init__(self, uid):
         self.uid = uid
         self.endpoints = {}
 
+        self.caller = None
+        self.timer = None
+
+        # Only known on the caller's worker.
+        self.callee = None
+        self.started = None
+        self.answered = None
+        self.first_ice = False
+
     def join(self, client):
         self.endpoints[client.nick] = client
 
@@ -81,26 +337,44 @@ class Conversation:
         del self.endpoints[client.nick]
 
     async def signal(self, sender, type, msg):
-        for nick, endpoint in self.endpoints.items():
-            if nick != sender.nick:
-                await endpoint.send_msg(type, msg)
+        await asyncio.gather(*[
+            endpoint.send_msg(type, msg)
+            for nick, endpoint in self.endpoints.items() if nick != sender.nick
+        ])
 
     @property
     def empty(self):
         return not bool(self.endpoints)
 
+    @property
+    def hosted(self):
+        return any(not isinstance(e, RemoteEndpoint) for e in self.endpoints.values())
+
     def __len__(self):
         return len(self.endpoints)
 
 
-# TODO: states seem to deserve their own objects to clean it all up
+class State:
+    """Connection state, holds the handlers of the client messages valid in it."""
+    __slots__ = ('name', 'handlers')
+
+    def __init__(self, name):
+        self.name = name
+        self.handlers = {}
+
+    def __str__(self):
+        return self.name
+
+
 class ClientEndpoint:
+    # Idle clients are most of the connections, keep them small.
+    __slots__ = ('server', 'outbox', 'state', 'nick', 'conversation', 'subscribed')
 
     # Client connection state
-    INIT = 'INIT'
-    LOGGED_IN = 'LOGGED IN'
-    RENDEZVOUS = 'RENDEZVOUS'
-    SIGNALLING = 'SIGNALLING'
+    INIT = State('INIT')
+    LOGGED_IN = State('LOGGED IN')
+    RENDEZVOUS = State('RENDEZVOUS')
+    SIGNALLING = State('SIGNALLING')
 
     # Messages from the client
     LOGIN = 'LOGIN'
@@ -109,58 +383,50 @@ class ClientEndpoint:
     REFUSE = 'REFUSE'
     CANCEL = 'CANCEL'
     HANGUP = 'HANGUP'
+    SUBSCRIBE = 'SUBSCRIBE'
 
     # Messages to the client
     ACCEPTED = 'ACCEPTED'
     REFUSED = 'REFUSED'
     CANCELLED = 'CANCELLED'
     HUNG_UP = 'HUNG_UP'
+    RECONNECT = 'RECONNECT'
 
     # From/to
     OFFER = 'OFFER'
     ANSWER = 'ANSWER'
     ICE = 'ICE_CANDIDATE'
 
-    def __init__(self, socket, server):
-        self.socket = socket
+    def __init__(self, socket, server, codec=LEGACY):
         self.server = server
+        self.outbox = Outbox(socket, codec, **server.outbox_options)
         self.state = ClientEndpoint.INIT
         self.nick = None  # TODO: should come from login process
-        self.token = None
         self.conversation = None
-
-        # Message handlers for states
-        self.handlers = {
-            (ClientEndpoint.INIT, ClientEndpoint.LOGIN): self.login,
-            (ClientEndpoint.LOGGED_IN, ClientEndpoint.CALL): self.call,
-            (ClientEndpoint.LOGGED_IN, ClientEndpoint.ACCEPT): self.accept,
-            (ClientEndpoint.LOGGED_IN, ClientEndpoint.REFUSE): self.refuse,
-            (ClientEndpoint.RENDEZVOUS, ClientEndpoint.CANCEL): self.cancel,
-            (ClientEndpoint.SIGNALLING, ClientEndpoint.HANGUP): self.hangup,
-            (ClientEndpoint.SIGNALLING, ClientEndpoint.OFFER): self.offer,
-            (ClientEndpoint.SIGNALLING, ClientEndpoint.ANSWER): self.answer,
-            (ClientEndpoint.SIGNALLING, ClientEndpoint.ICE): self.ice,
-        }
+        self.subscribed = False
 
     async def dispatch(self, type, msg):
-        handler = self.handlers.get((self.state, type), None)
+        handler = self.state.handlers.get(type, None)
         if handler:
-            await handler(msg)  # TODO: handle errors
+            start = time.perf_counter()
+            state = self.state
+            await handler(self, msg)  # TODO: handle errors
+            DISPATCH_LATENCY.labels(state.name, type).observe(time.perf_counter() - start)
         else:
-            logging.error(f'No handler found for {type} in state {self.state}')
+            logging.error('No handler found for %s in state %s', type, self.state)
 
     async def login(self, msg):
         nick = msg['nick']
-        token = self.server.get_token(nick)
+        token = await self.server.get_token(nick)
         if not token:
-            logging.error(f'No token on login for user: {nick}')
+            logging.error('No token on login for user: %s', nick)
             return
 
-        self.token = token
         self.nick = nick
         self.state = ClientEndpoint.LOGGED_IN
-        self.server.add_client(self)
-        logging.info(f'Logged in: {nick}')
+        await self.server.add_client(self)
+        self.server.resume(self)
+        logging.info('Logged in: %s', nick)
 
     async def call(self, msg):
         callee = msg['to']
@@ -168,120 +434,230 @@ class ClientEndpoint:
         self.conversation = await self.server.initiate_call(self.nick, callee)
         if self.conversation is not None:
             self.state = ClientEndpoint.RENDEZVOUS
-            logging.info(f'Incoming call pushed from {self.nick} to {callee}')
+            logging.info('Incoming call pushed from %s to %s', self.nick, callee)
         else:
-            logging.error(f'Incoming call from {self.nick} to {callee}: no token for {callee}')
+            logging.error('Incoming call from %s to %s: no token for %s', self.nick, callee, callee)
 
     async def accept(self, msg):
         caller = msg['to']
         call_id = msg['call_id']
         self.conversation = self.server.get_call(call_id)
+        caller_endpoint = self.server.get_endpoint(caller)
+
+        if self.conversation is None and isinstance(caller_endpoint, RemoteEndpoint):
+            # Caller's worker answers with CANCELLED if the call is gone.
+            self.conversation = self.server.mirror_call(call_id, caller_endpoint)
 
         if self.conversation is None:
             # TODO: handle errors
-            logging.info(f'Accept: call {call_id} has been cancelled')
+            logging.info('Accept: call %s has been cancelled', call_id)
             await self.send_msg(ClientEndpoint.CANCELLED, {})
             return
 
-        caller_endpoint = self.server.get_endpoint(caller)
         if not caller_endpoint:
             # TODO: handle errors
-            logging.error(f'Accept: user {caller} not found')
+            logging.error('Accept: user %s not found', caller)
             return
 
         self.conversation.join(self)
         self.state = ClientEndpoint.SIGNALLING
-        await caller_endpoint.on_accepted_call(self.nick)
+        await caller_endpoint.on_accepted_call(self.nick, call_id)
 
     async def refuse(self, msg):
         caller = msg['to']
         call_id = msg['call_id']
         self.conversation = self.server.get_call(call_id)
+        caller_endpoint = self.server.get_endpoint(caller)
 
-        if self.conversation is None:
+        if self.conversation is None and not isinstance(caller_endpoint, RemoteEndpoint):
             # TODO: handle errors
-            logging.info(f'Refuse: call {call_id} has been cancelled')
+            logging.info('Refuse: call %s has been cancelled', call_id)
             await self.send_msg(ClientEndpoint.CANCELLED, {})
             return
 
-        caller_endpoint = self.server.get_endpoint(caller)
         if not caller_endpoint:
             # TODO: handle errors
-            logging.error(f'Refuse: user {caller} not found')
+            logging.error('Refuse: user %s not found', caller)
         else:
             self.conversation = None
-            await caller_endpoint.on_refused_call(self.nick)
-            logging.info(f'Refuse from user {self.nick} to {caller}')
+            await caller_endpoint.on_refused_call(self.nick, call_id)
+            logging.info('Refuse from user %s to %s', self.nick, caller)
 
     async def hangup(self, msg):
         self.conversation.leave(self)
         uid = self.conversation.uid
 
-        if self.conversation.empty:
-            await self.server.end_call(uid)
-        elif len(self.conversation) == 1:
+        if len(self.conversation) == 1:
             await self.conversation.signal(
                 self,
                 ClientEndpoint.HUNG_UP,
                 {'from': self.nick, 'call_id': uid}
             )
+        if not self.conversation.hosted:
+            await self.server.end_call(uid)
 
         self.conversation = None
         self.state = ClientEndpoint.LOGGED_IN
-        logging.info(f'Call {uid} hangup by {self.nick}')
+        logging.info('Call %s hangup by %s', uid, self.nick)
 
     async def cancel(self, msg):
         uid = self.conversation.uid
-        await self.server.end_call(uid)
+        await self.server.end_call(uid, records.CANCELLED)
         self.conversation = None
 
         self.state = ClientEndpoint.LOGGED_IN
-        logging.info(f'Call {uid} cancelled by {self.nick}')
+        logging.info('Call %s cancelled by %s', uid, self.nick)
+
+    async def subscribe(self, msg):
+        if self.server.presence is None:
+            logging.error('Subscribe from %s: presence is disabled', self.nick)
+            return
+        await self.server.presence.subscribe(self)
+        logging.info('Presence subscribed by %s', self.nick)
 
     async def offer(self, msg):
         await self.conversation.signal(self, ClientEndpoint.OFFER, msg)
-        from pprint import pprint
-        pprint(msg)
-        logging.info(f'Offer published by {self.nick}: {msg}')
+        logging.info('Offer published by %s: %s', self.nick, msg, extra={'msg_type': ClientEndpoint.OFFER})
 
     async def answer(self, msg):
+        # Negotiated, the call lasts until hangup.
+        self.server.set_timer(self.conversation)
         await self.conversation.signal(self, ClientEndpoint.ANSWER, msg)
-        logging.info(f'Answer published by {self.nick}: {msg}')
+        logging.info('Answer published by %s: %s', self.nick, msg, extra={'msg_type': ClientEndpoint.ANSWER})
 
     async def ice(self, msg):
+        conversation = self.conversation
+        if conversation.started is not None and not conversation.first_ice:
+            conversation.first_ice = True
+            CALL_SETUP_LATENCY.labels('first_ice').observe(time.monotonic() - conversation.started)
+
         await self.conversation.signal(self, ClientEndpoint.ICE, msg)
-        logging.info(f'ICE candidate published by {self.nick}: {msg}')
+        logging.info('ICE candidate published by %s: %s', self.nick, msg, extra={'msg_type': ClientEndpoint.ICE})
 
-    async def on_accepted_call(self, callee):
+    async def on_accepted_call(self, callee, call_id):
         if self.state != ClientEndpoint.RENDEZVOUS:
-            logging.error(f'on_accepted_call from {callee} to {self.nick} in state {self.state}')
+            logging.error('on_accepted_call from %s to %s in state %s', callee, self.nick, self.state)
             return
 
         self.conversation.join(self)
         self.state = ClientEndpoint.SIGNALLING
+        self.server.set_timer(self.conversation, self.server.signalling_timeout, self.server.on_signalling_timeout)
+        if self.conversation.started is not None:
+            self.conversation.answered = time.monotonic()
+            CALL_SETUP_LATENCY.labels('accepted').observe(self.conversation.answered - self.conversation.started)
         await self.send_msg(ClientEndpoint.ACCEPTED, {'from': self.nick, 'to': callee})
-        logging.info(f'Accepted call pushed to: {self.nick}')
+        logging.info('Accepted call pushed to: %s', self.nick)
 
-    async def on_refused_call(self, callee):
+    async def on_refused_call(self, callee, call_id):
         if self.state != ClientEndpoint.RENDEZVOUS:
-            logging.error(f'on_refused_call from {callee} to {self.nick} in state {self.state}')
+            logging.error('on_refused_call from %s to %s in state %s', callee, self.nick, self.state)
             return
 
+        await self.server.end_call(self.conversation.uid, records.REFUSED)
         self.conversation = None
         self.state = ClientEndpoint.LOGGED_IN
         await self.send_msg(ClientEndpoint.REFUSED, {'from': self.nick, 'to': callee})
-        logging.info(f'Refused call pushed to: {self.nick}')
+        logging.info('Refused call pushed to: %s', self.nick)
+
+    async def on_cancelled_call(self, call_id, reason=records.CANCELLED):
+        if self.conversation is None or self.conversation.uid != call_id:
+            logging.error('on_cancelled_call %s to %s in state %s', call_id, self.nick, self.state)
+            return
+
+        await self.server.end_call(call_id, reason)
+        self.conversation = None
+        self.state = ClientEndpoint.LOGGED_IN
+        await self.send_msg(ClientEndpoint.CANCELLED, {})
+        logging.info('Cancelled call pushed to: %s', self.nick)
+
+    async def on_disconnect(self):
+        # Draining, the call is handed over to the next process.
+        if self.server.draining:
+            return
+
+        # Don't leave the call behind, the peer is told as if we hung up.
+        if self.state == ClientEndpoint.RENDEZVOUS:
+            await self.cancel({})
+        elif self.state == ClientEndpoint.SIGNALLING:
+            await self.hangup({})
 
     async def send_msg(self, type, payload):
-        payload_json = json.dumps(payload)
-        ws_msg = json.dumps({'type': type, 'payload': payload_json})
-        await self.socket.send_json(ws_msg)
+        # Queued, a slow client must not block the sender.
+        self.outbox.put(type, payload)
 
+    async def restart(self, after, timeout):
+        # Tell the client when to come back, then close once the hint is written.
+        await self.send_msg(ClientEndpoint.RECONNECT, {'after': after})
+        await self.outbox.shutdown(WSCloseCode.SERVICE_RESTART, timeout)
 
-def setup_server(app):
+    def close(self):
+        self.outbox.close()
+
+    # Message handlers for states, shared by all endpoints.
+    INIT.handlers[LOGIN] = login
+    LOGGED_IN.handlers.update({CALL: call, ACCEPT: accept, REFUSE: refuse, SUBSCRIBE: subscribe})
+    RENDEZVOUS.handlers.update({CANCEL: cancel, SUBSCRIBE: subscribe})
+    SIGNALLING.handlers.update({HANGUP: hangup, OFFER: offer, ANSWER: answer, ICE: ice, SUBSCRIBE: subscribe})
+
+
+class RemoteEndpoint:
+    """Stand-in for a client connected to another worker."""
+    __slots__ = ('nick', 'bus')
+
+    def __init__(self, nick, bus):
+        self.nick = nick
+        self.bus = bus
+
+    async def on_accepted_call(self, callee, call_id):
+        await self.bus.send(self.nick, ClientEndpoint.ACCEPTED, {'callee': callee, 'call_id': call_id})
+
+    async def on_refused_call(self, callee, call_id):
+        await self.bus.send(self.nick, ClientEndpoint.REFUSED, {'callee': callee, 'call_id': call_id})
+
+    async def send_msg(self, type, payload):
+        await self.bus.send(self.nick, type, payload)
+
+
+def setup_server(app, config, bus=None):
     async def _setup(app):
-        server = Server(app['storage'])
+        tokens = TokenCache(
+            app['storage'],
+            ttl=config.getfloat('TOKENS', 'CACHE TTL', fallback=300),
+            max_size=config.getint('TOKENS', 'CACHE SIZE', fallback=100000),
+        )
+        server = Server(
+            app['storage'], app['notifications'], bus, tokens,
+            ring_timeout=config.getfloat('CALLS', 'RING TIMEOUT', fallback=45),
+            signalling_timeout=config.getfloat('CALLS', 'SIGNALLING TIMEOUT', fallback=30),
+            recorder=records.CallRecorder(
+                app['storage'],
+                flush_size=config.getint('RECORDS', 'FLUSH SIZE', fallback=500),
+                flush_interval=config.getfloat('RECORDS', 'FLUSH INTERVAL', fallback=1.0),
+                max_pending=config.getint('RECORDS', 'MAX PENDING', fallback=50000),
+            ),
+            friends=app['friends'],
+        )
+        CLIENTS.set_function(lambda: len(server.clients))
+        CALLS.set_function(lambda: len(server.calls))
+        RENDEZVOUS.set_function(
+            lambda: sum(1 for c in server.clients.values() if c.state == ClientEndpoint.RENDEZVOUS)
+        )
+        server.outbox_options = {
+            'size': config.getint('OUTBOX', 'SIZE', fallback=256),
+            'policy': config.get('OUTBOX', 'POLICY', fallback='evict'),
+            'send_timeout': config.getfloat('OUTBOX', 'SEND TIMEOUT', fallback=5.0),
+            'coalesce': config.getboolean('OUTBOX', 'COALESCE', fallback=True),
+        }
         await server.setup()
         app['server'] = server
 
+    async def _shutdown(app):
+        # Before the storage is closed on cleanup.
+        await app['server'].recorder.close()
+
+    async def _cleanup(app):
+        await app['server'].close()
+
     app.on_startup.append(_setup)
+    app.on_shutdown.append(_shutdown)
+    app.on_cleanup.append(_cleanup)
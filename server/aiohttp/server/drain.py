@@ -0,0 +1,85 @@
+import asyncio
+import json
+import logging
+import os
+import random
+import time
+
+from server.bus import LocalBus
+from server.limits import TokenBucket
+
+
+def save_snapshot(path, calls):
+    # Written aside and renamed, the next process never reads half a file.
+    tmp = f'{path}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump({'time': time.time(), 'calls': calls}, f)
+    os.replace(tmp, path)
+
+
+def load_snapshot(path, max_age):
+    try:
+        with open(path) as f:
+            snapshot = json.load(f)
+    except FileNotFoundError:
+        return []
+    except ValueError as e:
+        logging.error('Call snapshot %s unreadable: %r', path, e)
+        return []
+    finally:
+        # Restored at most once.
+        if os.path.exists(path):
+            os.remove(path)
+
+    if time.time() - snapshot['time'] > max_age:
+        logging.info('Call snapshot %s too old, ignored', path)
+        return []
+    return snapshot['calls']
+
+
+async def drain(server, path, reconnect_min, reconnect_max, timeout):
+    # The listening socket is already closed by the time shutdown hooks run.
+    server.draining = True
+
+    # Clients of other workers may come back to any of them, only a single process hands calls over.
+    if isinstance(server.bus, LocalBus):
+        calls = server.snapshot()
+        save_snapshot(path, calls)
+        logging.info('Snapshot of %d calls saved to %s', len(calls), path)
+
+    # Spread the reconnects so that the next process isn't hit by all clients at once.
+    clients = list(server.clients.values())
+    logging.info('Draining %d clients', len(clients))
+    await asyncio.gather(*[
+        client.restart(round(random.uniform(reconnect_min, reconnect_max), 1), timeout) for client in clients
+    ], return_exceptions=True)
+
+
+def setup_drain(app, config):
+    section = 'DRAIN'
+    path = config.get(section, 'SNAPSHOT PATH', fallback='/tmp/deep_noise-calls.json')
+
+    # Logins hash with bcrypt, admit them at a pace the pool can take after a restart.
+    app['logins'] = TokenBucket(
+        rate=config.getfloat(section, 'LOGIN RATE', fallback=50),
+        burst=config.getint(section, 'LOGIN BURST', fallback=100),
+    )
+
+    async def _restore(app):
+        if not isinstance(app['server'].bus, LocalBus):
+            return
+        calls = load_snapshot(path, config.getfloat(section, 'SNAPSHOT MAX AGE', fallback=120))
+        if calls:
+            app['server'].restore(calls, config.getfloat(section, 'RESTORE TIMEOUT', fallback=60))
+            logging.info('Restored %d calls from %s', len(calls), path)
+
+    async def _drain(app):
+        await drain(
+            app['server'], path,
+            reconnect_min=config.getfloat(section, 'RECONNECT MIN', fallback=1),
+            reconnect_max=config.getfloat(section, 'RECONNECT MAX', fallback=30),
+            timeout=config.getfloat(section, 'FLUSH TIMEOUT', fallback=2),
+        )
+
+    app.on_startup.append(_restore)
+    app.on_shutdown.append(_drain)
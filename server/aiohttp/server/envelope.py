@@ -0,0 +1,77 @@
+import json
+from aiohttp import WSMsgType
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+__all__ = ['PROTOCOLS', 'LEGACY', 'get_codec']
+
+
+if orjson is not None:
+    def dumps(obj):
+        return orjson.dumps(obj).decode()
+
+    loads = orjson.loads
+else:
+    dumps = json.dumps
+    loads = json.loads
+
+
+class LegacyCodec:
+    """v1: payload is a JSON string inside a JSON object inside a JSON string (old app builds)."""
+    frame = WSMsgType.TEXT
+
+    def decode(self, data):
+        msg_obj = json.loads(json.loads(data))
+        return msg_obj['type'], json.loads(msg_obj['payload'])
+
+    async def send(self, socket, type, payload):
+        payload_json = json.dumps(payload)
+        ws_msg = json.dumps({'type': type, 'payload': payload_json})
+        await socket.send_json(ws_msg)
+
+
+class JSONCodec:
+    """v2: flat {"type": ..., "payload": {...}} text frames."""
+    frame = WSMsgType.TEXT
+
+    def decode(self, data):
+        msg_obj = loads(data)
+        return msg_obj['type'], msg_obj['payload']
+
+    async def send(self, socket, type, payload):
+        await socket.send_str(dumps({'type': type, 'payload': payload}))
+
+
+class MsgpackCodec:
+    """v2: the same flat envelope in msgpack binary frames."""
+    frame = WSMsgType.BINARY
+
+    def decode(self, data):
+        msg_obj = msgpack.unpackb(data)
+        return msg_obj['type'], msg_obj['payload']
+
+    async def send(self, socket, type, payload):
+        await socket.send_bytes(msgpack.packb({'type': type, 'payload': payload}))
+
+
+LEGACY = LegacyCodec()
+
+# Offered as WebSocket subprotocols, clients that ask for none get the legacy format.
+CODECS = {'deepnoise.v2.json': JSONCodec()}
+if msgpack is not None:
+    CODECS['deepnoise.v2.msgpack'] = MsgpackCodec()
+
+# Server preference order.
+PROTOCOLS = tuple(reversed(list(CODECS)))
+
+
+def get_codec(protocol):
+    return CODECS.get(protocol, LEGACY)
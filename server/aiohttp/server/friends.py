@@ -0,0 +1,114 @@
+import asyncio
+import logging
+import sys
+import time
+from collections import OrderedDict
+
+
+class FriendGraph:
+    """Adjacency sets of the friendship graph, loaded lazily per user.
+
+    Least recently used users are evicted once the estimated size exceeds the budget.
+    Friendships are written through, entries also expire after `ttl` so workers that
+    did not see a write catch up.
+    """
+
+    def __init__(self, storage, budget=64 * 2 ** 20, ttl=60):
+        self.storage = storage
+        self.budget = budget
+        self.ttl = ttl
+        self.size = 0
+
+        # login -> (friends, expires, size, version)
+        self.entries = OrderedDict()
+        self.loading = {}
+        self.pending = {}
+
+        # Coroutines called with both logins of a new friendship.
+        self.listeners = []
+
+    async def friends(self, login, version=None):
+        # With a version read from the DB, entries loaded before it are stale whatever their age.
+        entry = self.entries.get(login, None)
+        if entry is not None and entry[1] > time.monotonic() and (version is None or entry[3] >= version):
+            self.entries.move_to_end(login)
+            return entry[0]
+
+        # Coalesce concurrent loads of the same user.
+        if login in self.loading:
+            future, loading_version = self.loading[login]
+            friends = await asyncio.shield(future)
+            if version is None or loading_version >= version:
+                return friends
+            # The load may have missed the write that made `version`.
+            return await self.friends(login, version)
+
+        future = asyncio.get_running_loop().create_future()
+        self.loading[login] = (future, version or 0)
+        self.pending[login] = set()
+        try:
+            rows = await self.storage.get_friends(login)
+            friends = {row[0] for row in rows} | self.pending[login]
+            self._put(login, friends, version or 0)
+            future.set_result(friends)
+            return friends
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            del self.loading[login]
+            del self.pending[login]
+
+    async def are_friends(self, login, other):
+        return other in await self.friends(login)
+
+    async def add_friendship(self, login, invited):
+        await self.storage.add_friendship(login, invited)
+        await self.on_friendship(login, invited)
+
+    async def on_friendship(self, login, invited):
+        # Write-through for friendships stored elsewhere.
+        self.add_edge(login, invited)
+        self.add_edge(invited, login)
+
+        for listener in self.listeners:
+            try:
+                await listener(login, invited)
+            except Exception as e:
+                logging.error('Friendship listener failed: %r', e)
+
+    def invalidate(self, login):
+        entry = self.entries.pop(login, None)
+        if entry is not None:
+            self.size -= entry[2]
+
+    def add_edge(self, login, friend):
+        if login in self.pending:
+            self.pending[login].add(friend)
+
+        entry = self.entries.get(login, None)
+        if entry is not None:
+            entry[0].add(friend)
+            # Keep the estimate, it's refreshed on the next load.
+
+    def _put(self, login, friends, version):
+        self.invalidate(login)
+
+        size = sys.getsizeof(friends) + sum(sys.getsizeof(f) for f in friends)
+        self.entries[login] = (friends, time.monotonic() + self.ttl, size, version)
+        self.size += size
+
+        while self.size > self.budget and len(self.entries) > 1:
+            _, (_, _, evicted, _) = self.entries.popitem(last=False)
+            self.size -= evicted
+
+
+def setup_friends(app, config):
+    async def _setup(app):
+        app['friends'] = FriendGraph(
+            app['storage'],
+            budget=config.getint('FRIENDS', 'CACHE BUDGET', fallback=64 * 2 ** 20),
+            ttl=config.getfloat('FRIENDS', 'CACHE TTL', fallback=60),
+        )
+
+    app.on_startup.append(_setup)
@@ -0,0 +1,132 @@
+import asyncio
+import math
+import random
+import time
+from collections import OrderedDict
+
+from aiohttp import web
+from aiohttp_security import authorized_userid
+
+from server.metrics import Counter
+
+REJECTED = Counter(
+    'deepnoise_rejected_requests_total', 'Requests turned away by admission control.', ['route', 'reason']
+)
+
+
+class TokenBucket:
+    """Admits `rate` events per second on average, in bursts of up to `burst`."""
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def delay(self):
+        # Seconds until the next event would be admitted.
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+
+class KeyedBuckets:
+    """A token bucket per identity, the least recently seen are forgotten."""
+
+    def __init__(self, rate, burst, max_keys=100000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self.buckets = OrderedDict()
+
+    def get(self, key):
+        bucket = self.buckets.get(key, None)
+        if bucket is None:
+            bucket = self.buckets[key] = TokenBucket(self.rate, self.burst)
+            if len(self.buckets) > self.max_keys:
+                self.buckets.popitem(last=False)
+        else:
+            self.buckets.move_to_end(key)
+        return bucket
+
+
+class AdmissionControl:
+    """Per-identity rate limits and global concurrency caps of REST routes.
+
+    Over its rate a client gets 429, a route at its cap queues requests for up to
+    `queue_timeout` and then sheds them with 503. Both carry Retry-After.
+    """
+
+    def __init__(self, rates=None, concurrency=None, queue_timeout=0.5, max_identities=100000):
+        self.rates = {
+            route: KeyedBuckets(rate, burst, max_identities) for route, (rate, burst) in (rates or {}).items()
+        }
+        self.slots = {route: asyncio.Semaphore(limit) for route, limit in (concurrency or {}).items()}
+        self.queue_timeout = queue_timeout
+
+    @web.middleware
+    async def middleware(self, request, handler):
+        route = request.match_info.route.resource
+        route = route.canonical if route is not None else None
+
+        buckets = self.rates.get(route, None)
+        if buckets is not None:
+            # Before login there's no identity, the address stands in.
+            identity = await authorized_userid(request) or request.remote
+            bucket = buckets.get(identity)
+            if not bucket.take():
+                REJECTED.labels(route, 'rate').inc()
+                raise web.HTTPTooManyRequests(headers={'Retry-After': str(math.ceil(bucket.delay()))})
+
+        slots = self.slots.get(route, None)
+        if slots is None:
+            return await handler(request)
+
+        try:
+            await asyncio.wait_for(slots.acquire(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            REJECTED.labels(route, 'concurrency').inc()
+            raise web.HTTPServiceUnavailable(headers={'Retry-After': str(random.randint(1, 5))})
+        try:
+            return await handler(request)
+        finally:
+            slots.release()
+
+
+def parse_limits(value, parse):
+    # "/login=0.2/5, /users/search=5/20" -> {'/login': parse('0.2/5'), ...}
+    limits = {}
+    for item in filter(None, (i.strip() for i in value.split(','))):
+        route, limit = item.split('=')
+        limits[route.strip()] = parse(limit.strip())
+    return limits
+
+
+def parse_rate(value):
+    rate, burst = value.split('/')
+    return float(rate), int(burst)
+
+
+def setup_limits(app, config):
+    section = 'LIMITS'
+    admission = AdmissionControl(
+        rates=parse_limits(config.get(section, 'RATES', fallback=''), parse_rate),
+        concurrency=parse_limits(config.get(section, 'CONCURRENCY', fallback=''), int),
+        queue_timeout=config.getfloat(section, 'QUEUE TIMEOUT', fallback=0.5),
+        max_identities=config.getint(section, 'MAX IDENTITIES', fallback=100000),
+    )
+
+    async def _setup(app):
+        # Runs after auth's startup hook, inside the session middleware it installs.
+        app.middlewares.append(admission.middleware)
+
+    app.on_startup.append(_setup)
@@ -0,0 +1,308 @@
+# Drive simulated clients through REST and the signalling state machine of an in-process app:
+#   python -m server.loadtest --clients 2000 --calls 500
+import argparse
+import asyncio
+import json
+import logging
+import random
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+import aiohttp
+import bcrypt
+from aiohttp import web
+
+from server.envelope import msgpack
+from server.loadtest.storage import SQLiteStorage
+from server.main import create_app, read_config
+from server.notifications import SENT, FakeBackend
+
+PASSWORD = 'password'
+
+
+def rss():
+    # Current resident set size in bytes.
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.statuses = defaultdict(int)
+        self.failures = 0
+
+    def add(self, name, seconds):
+        self.latencies[name].append(seconds)
+
+    def report(self, phase, duration):
+        print(f'\n{phase} ({duration:.2f} s)')
+        print(f'{"operation":<16}{"count":>8}{"ops/s":>10}{"p50 ms":>10}{"p99 ms":>10}')
+        for name, samples in sorted(self.latencies.items()):
+            ordered = sorted(samples)
+            p50 = ordered[len(ordered) // 2] * 1000
+            p99 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))] * 1000
+            print(f'{name:<16}{len(ordered):>8}{len(ordered) / duration:>10.1f}{p50:>10.2f}{p99:>10.2f}')
+        for status, count in sorted(self.statuses.items()):
+            print(f'  {status}: {count}')
+        failed = sum(count for status, count in self.statuses.items() if status.endswith(' failed'))
+        if failed:
+            print(f'  FAILED: {failed} requests not answered with 2xx, the numbers above include them')
+        self.failures += failed
+        self.latencies.clear()
+        self.statuses.clear()
+
+
+class PushRouter(FakeBackend):
+    """Fake FCM that hands pushes straight to the simulated phones."""
+
+    def __init__(self, loop, clients, **kwargs):
+        super().__init__(**kwargs)
+        self.loop = loop
+        self.clients = clients
+
+    def send(self, entries):
+        outcomes = super().send(entries)
+        for entry, outcome in zip(entries, outcomes):
+            client = self.clients.get(entry.token, None)
+            if outcome == SENT and client is not None:
+                # Called from the dispatcher's pool thread.
+                self.loop.call_soon_threadsafe(client.deliver, entry.payload['type'], entry.payload)
+        self.sent.clear()
+        return outcomes
+
+
+class SimClient:
+    def __init__(self, login, url, connector, recorder, envelope):
+        self.login = login
+        self.token = f'token-{login}'
+        self.url = url
+        self.recorder = recorder
+        self.envelope = envelope
+        # The app is served on 127.0.0.1, the default jar drops cookies of IP hosts.
+        self.session = aiohttp.ClientSession(
+            connector=connector, connector_owner=False, cookie_jar=aiohttp.CookieJar(unsafe=True)
+        )
+        self.ws = None
+        self.reader = None
+        self.inbox = defaultdict(asyncio.Queue)
+
+    async def close(self):
+        if self.ws is not None:
+            await self.ws.close()
+        await self.session.close()
+
+    async def request(self, name, method, path, **kwargs):
+        start = time.perf_counter()
+        async with self.session.request(method, self.url + path, **kwargs) as response:
+            await response.read()
+            self.recorder.add(name, time.perf_counter() - start)
+            self.recorder.statuses[f'{name} {response.status}'] += 1
+            if not 200 <= response.status < 300:
+                self.recorder.statuses[f'{name} failed'] += 1
+            return response.status
+
+    async def rest_session(self, others, invitee):
+        await self.request('login', 'POST', '/login', json={'login': self.login, 'password': PASSWORD})
+        await self.request('token', 'POST', '/token', json={'token': self.token})
+        await self.request('friends', 'GET', '/users/friends')
+        await self.request('search', 'GET', '/users/search', params={'query': random.choice(others)[:5]})
+        if invitee is not None:
+            await self.request('invite', 'POST', '/users/invite', json={'login': invitee})
+
+    async def connect(self):
+        protocols = () if self.envelope == 'legacy' else (f'deepnoise.v2.{self.envelope}',)
+        self.ws = await self.session.ws_connect(self.url + '/', protocols=protocols)
+        self.reader = asyncio.create_task(self._read())
+        await self.send('LOGIN', {'nick': self.login})
+
+    async def send(self, type, payload):
+        if self.envelope == 'legacy':
+            await self.ws.send_json(json.dumps({'type': type, 'payload': json.dumps(payload)}))
+        elif self.envelope == 'msgpack':
+            await self.ws.send_bytes(msgpack.packb({'type': type, 'payload': payload}))
+        else:
+            await self.ws.send_str(json.dumps({'type': type, 'payload': payload}))
+
+    def deliver(self, type, payload):
+        self.inbox[type].put_nowait(payload)
+
+    async def expect(self, type, timeout=30):
+        return await asyncio.wait_for(self.inbox[type].get(), timeout)
+
+    async def _read(self):
+        async for msg in self.ws:
+            if msg.type == aiohttp.WSMsgType.BINARY:
+                obj = msgpack.unpackb(msg.data)
+                self.deliver(obj['type'], obj['payload'])
+            elif msg.type != aiohttp.WSMsgType.TEXT:
+                continue
+            elif self.envelope == 'legacy':
+                obj = json.loads(json.loads(msg.data))
+                self.deliver(obj['type'], json.loads(obj['payload']))
+            else:
+                obj = json.loads(msg.data)
+                self.deliver(obj['type'], obj['payload'])
+
+
+async def call(caller, callee, recorder, args):
+    start = time.perf_counter()
+    await caller.send('CALL', {'to': callee.login})
+    incoming = await callee.expect('INCOMING')
+    recorder.add('push', time.perf_counter() - start)
+
+    answer = {'to': caller.login, 'call_id': incoming['call_id']}
+    if random.random() < args.refuse_ratio:
+        await callee.send('REFUSE', answer)
+        await caller.expect('REFUSED')
+        recorder.add('refused', time.perf_counter() - start)
+        return
+
+    await callee.send('ACCEPT', answer)
+    await caller.expect('ACCEPTED')
+    recorder.add('accepted', time.perf_counter() - start)
+
+    offer_start = time.perf_counter()
+    await caller.send('OFFER', {'type': 'offer', 'sdp': 'x' * args.sdp_size})
+    await callee.expect('OFFER')
+    await callee.send('ANSWER', {'type': 'answer', 'sdp': 'x' * args.sdp_size})
+    await caller.expect('ANSWER')
+    recorder.add('offer_answer', time.perf_counter() - offer_start)
+
+    ice_start = time.perf_counter()
+    candidate = {'sdpMid': 'audio', 'sdpMLineIndex': 0, 'sdp': 'candidate:' + 'x' * 100}
+    for i in range(args.ice):
+        await caller.send('ICE_CANDIDATE', candidate)
+        await callee.send('ICE_CANDIDATE', candidate)
+    for i in range(args.ice):
+        await caller.expect('ICE_CANDIDATE')
+        await callee.expect('ICE_CANDIDATE')
+    recorder.add('ice_burst', time.perf_counter() - ice_start)
+    recorder.add('call_setup', time.perf_counter() - start)
+
+    await caller.send('HANGUP', {})
+    await callee.expect('HUNG_UP')
+    await callee.send('HANGUP', {})
+
+
+async def bounded(semaphore, coro):
+    async with semaphore:
+        return await coro
+
+
+async def run(args):
+    logging.basicConfig(level=logging.WARNING)
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    # The snapshot of a real server on this host must survive the run.
+    snapshot_dir = tempfile.mkdtemp(prefix='deep_noise-loadtest-')
+
+    config = read_config(args.config)
+    config.read_dict({
+        'NOTIFICATIONS': {'BACKEND': 'fake'},
+        'AUTH': {'BCRYPT COST': '4'},
+        'CALLS': {'RING TIMEOUT': '120', 'SIGNALLING TIMEOUT': '120'},
+        # Measures the server, not the admission control; no calls carried over between runs.
+        'DRAIN': {
+            'LOGIN RATE': '1000000', 'LOGIN BURST': '1000000', 'SNAPSHOT MAX AGE': '0',
+            'SNAPSHOT PATH': os.path.join(snapshot_dir, 'calls.json'),
+        },
+        # All simulated clients share one address before they log in, and shed requests would
+        # be timed along with served ones: the run measures the server, not admission control.
+        'LIMITS': {'RATES': '', 'CONCURRENCY': ''},
+    })
+
+    logins = [f'user{i}' for i in range(args.clients)]
+    storage = None
+    if not args.postgres:
+        storage = SQLiteStorage()
+        password_hash = bcrypt.hashpw(PASSWORD.encode(), bcrypt.gensalt(4)).decode()
+        storage.add_users([(login, password_hash, f'token-{login}') for login in logins])
+        for a, b in zip(logins[::2], logins[1::2]):
+            await storage.add_friendship(a, b)
+
+    phones = {}
+    app = create_app(config, storage=storage, push_backend=PushRouter(asyncio.get_running_loop(), phones))
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    host, port = runner.addresses[0][:2]
+    url = f'http://{host}:{port}'
+
+    recorder = Recorder()
+    connector = aiohttp.TCPConnector(limit=0)
+    clients = [SimClient(login, url, connector, recorder, args.envelope) for login in logins]
+    phones.update({c.token: c for c in clients})
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    try:
+        start = time.perf_counter()
+        # Two ahead is neither a friend nor inviting back, unless there are too few clients.
+        invitees = [logins[(i + 2) % len(logins)] if len(logins) > 4 else None for i in range(len(logins))]
+        await asyncio.gather(*[
+            bounded(semaphore, c.rest_session(logins, invitee)) for c, invitee in zip(clients, invitees)
+        ])
+        recorder.report('REST', time.perf_counter() - start)
+
+        rss_before = rss()
+        start = time.perf_counter()
+        await asyncio.gather(*[bounded(semaphore, c.connect()) for c in clients])
+        await asyncio.sleep(0.5)
+        duration = time.perf_counter() - start
+        rss_after = rss()
+        print(f'\nWebSocket: {len(clients)} connected in {duration:.2f} s, '
+              f'{(rss_after - rss_before) / len(clients):.0f} B RSS per connection (client and server side)')
+
+        # A client takes part in one call at a time, so calls run in rounds of disjoint pairs.
+        start = time.perf_counter()
+        remaining = args.calls
+        while remaining > 0:
+            shuffled = random.sample(clients, len(clients))
+            pairs = list(zip(shuffled[::2], shuffled[1::2]))[:remaining]
+            remaining -= len(pairs)
+
+            results = await asyncio.gather(
+                *[bounded(semaphore, call(a, b, recorder, args)) for a, b in pairs], return_exceptions=True
+            )
+            for r in results:
+                if isinstance(r, Exception):
+                    recorder.statuses[f'call failed: {type(r).__name__}'] += 1
+        recorder.report('Signalling', time.perf_counter() - start)
+
+    finally:
+        for c in clients:
+            await c.close()
+        await connector.close()
+        await runner.cleanup()
+        shutil.rmtree(snapshot_dir, ignore_errors=True)
+
+    return 1 if recorder.failures else 0
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', default='config.ini')
+    parser.add_argument('--clients', type=int, default=1000)
+    parser.add_argument('--calls', type=int, default=200)
+    parser.add_argument('--ice', type=int, default=10, help='ICE candidates per party and call')
+    parser.add_argument('--sdp_size', type=int, default=2000)
+    parser.add_argument('--refuse_ratio', type=float, default=0.1)
+    parser.add_argument('--concurrency', type=int, default=200)
+    parser.add_argument('--envelope', choices=['legacy', 'json', 'msgpack'], default='json')
+    parser.add_argument('--postgres', action='store_true',
+                        help='use [DATABASE] URL instead of SQLite, users user0.. must exist with this password')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    sys.exit(asyncio.run(run(parse_args())))
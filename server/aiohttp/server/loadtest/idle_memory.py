@@ -0,0 +1,73 @@
+# Bytes the server keeps per idle, logged in WebSocket client:
+#   python -m server.loadtest.idle_memory --clients 100000
+# Counts what the signalling server allocates (endpoint, outbox, registry and token cache
+# entries), not aiohttp's own per-connection objects, see the load test for those.
+import argparse
+import asyncio
+import gc
+import tracemalloc
+
+from server.call import ClientEndpoint, Server
+from server.envelope import LEGACY
+from server.loadtest.storage import SQLiteStorage
+from server.notifications import Dispatcher, FakeBackend
+
+
+class Socket:
+    async def send_str(self, data):
+        pass
+
+    async def send_json(self, data):
+        pass
+
+    async def close(self, code=None):
+        pass
+
+
+async def connect(server, socket, logins):
+    endpoints = []
+    for login in logins:
+        endpoint = ClientEndpoint(socket=socket, server=server, codec=LEGACY)
+        await endpoint.dispatch(ClientEndpoint.LOGIN, {'nick': login})
+        endpoints.append(endpoint)
+    return endpoints
+
+
+async def run(args):
+    logins = [f'user{i}' for i in range(args.clients)]
+    storage = SQLiteStorage()
+    storage.add_users([(login, 'x', f'token-{login}') for login in logins])
+
+    server = Server(storage, Dispatcher(FakeBackend()))
+    await server.setup()
+    socket = Socket()
+
+    # Warm up so that one-off allocations (interned strings, metric children) aren't counted.
+    warmup = await connect(server, socket, [logins[0]])
+    for endpoint in warmup:
+        endpoint.close()
+        await server.rm_client(endpoint)
+    server.tokens.entries.clear()
+
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+
+    endpoints = await connect(server, socket, logins)
+
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    print(f'{len(endpoints)} idle clients: {(after - before) / len(endpoints):.0f} B per connection')
+
+    await server.close()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--clients', type=int, default=100000)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    asyncio.run(run(parse_args()))
@@ -0,0 +1,68 @@
+# Rate-limited routes under the shipped configuration, answered with 200 and then 429, never 5xx:
+#   python -m server.loadtest.limits_check
+import argparse
+import asyncio
+import sys
+from collections import Counter
+
+import aiohttp
+import bcrypt
+from aiohttp import web
+
+from server.loadtest.storage import SQLiteStorage
+from server.main import create_app, read_config
+
+PASSWORD = 'password'
+
+
+async def run(args):
+    config = read_config(args.config)
+    config.read_dict({'NOTIFICATIONS': {'BACKEND': 'fake'}, 'AUTH': {'BCRYPT COST': '4'}})
+
+    storage = SQLiteStorage()
+    password_hash = bcrypt.hashpw(PASSWORD.encode(), bcrypt.gensalt(4)).decode()
+    storage.add_users([(login, password_hash, f'token-{login}') for login in ('alice', 'bob')])
+    await storage.add_friendship('alice', 'bob')
+
+    app = create_app(config, storage=storage)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    url = f'http://127.0.0.1:{runner.addresses[0][1]}'
+
+    statuses = Counter()
+    # The default jar drops cookies of IP hosts.
+    async with aiohttp.ClientSession(cookie_jar=aiohttp.CookieJar(unsafe=True)) as session:
+        try:
+            async with session.post(url + '/login', json={'login': 'alice', 'password': PASSWORD}) as response:
+                statuses[f'/login {response.status}'] += 1
+
+            for path, params in [('/users/search', {'query': 'bo'}), ('/users/friends', {}), ('/invitations', {})]:
+                for _ in range(args.requests):
+                    async with session.get(url + path, params=params) as response:
+                        await response.read()
+                        statuses[f'{path} {response.status}'] += 1
+        finally:
+            await runner.cleanup()
+
+    for status, count in sorted(statuses.items()):
+        print(f'{status}: {count}')
+
+    failed = [s for s in statuses if not s.endswith((' 200', ' 429'))]
+    limited = [s for s in statuses if s.endswith(' 429')]
+    if failed or len(limited) < 3:
+        print('FAILED: expected only 200 and 429, and every route limited', file=sys.stderr)
+        return 1
+    return 0
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', default='config.ini')
+    parser.add_argument('--requests', type=int, default=50, help='per route, past the configured burst')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    sys.exit(asyncio.run(run(parse_args())))
@@ -0,0 +1,162 @@
+import sqlite3
+
+from server.storage import InviteResult, InviteStatus, Storage, Versions, escape_like
+
+schema = (
+    'CREATE TABLE users('
+    ' id INTEGER PRIMARY KEY, login TEXT UNIQUE NOT NULL, password TEXT NOT NULL, token TEXT,'
+    ' friends_version INTEGER NOT NULL DEFAULT 0, invitations_version INTEGER NOT NULL DEFAULT 0);'
+    'CREATE TABLE invitations('
+    ' id INTEGER PRIMARY KEY, from_user INTEGER REFERENCES users(id), to_user INTEGER REFERENCES users(id),'
+    ' UNIQUE (from_user, to_user));'
+    'CREATE TABLE friendships('
+    ' id INTEGER PRIMARY KEY, from_user INTEGER REFERENCES users(id), to_user INTEGER REFERENCES users(id),'
+    ' UNIQUE (from_user, to_user));'
+    'CREATE TABLE call_records('
+    ' call_id TEXT PRIMARY KEY, caller TEXT, callee TEXT, ring_at TEXT, answered_at TEXT, ended_at TEXT,'
+    ' duration REAL, end_reason TEXT);'
+)
+
+
+class SQLiteStorage(Storage):
+    """In-memory SQLite stand-in for DBStorage, so load tests need no Postgres.
+
+    Queries run synchronously, an in-memory database answers in microseconds.
+    """
+
+    def __init__(self, path=':memory:'):
+        self.db = sqlite3.connect(path)
+        self.db.row_factory = sqlite3.Row
+        self.db.create_function('similarity', 2, lambda a, b: 1.0 / (1 + abs(len(a) - len(b))))
+        self.db.executescript(schema)
+
+    async def close(self):
+        self.db.close()
+
+    def add_users(self, users):
+        # [(login, password_hash, token)]
+        with self.db:
+            self.db.executemany('INSERT INTO users(login, password, token) VALUES(?, ?, ?)', users)
+
+    def _bump(self, version, ids):
+        self.db.execute(f'UPDATE users SET {version} = {version} + 1 WHERE id IN (?, ?)', ids)
+
+    def _user_id(self, login):
+        row = self.db.execute('SELECT id FROM users WHERE login = ?', (login,)).fetchone()
+        return row[0] if row else None
+
+    async def registered(self, login):
+        return self._user_id(login) is not None
+
+    async def get_hash(self, login):
+        row = self.db.execute('SELECT password FROM users WHERE login = ?', (login,)).fetchone()
+        return row[0] if row else None
+
+    async def set_hash(self, login, password_hash):
+        with self.db:
+            self.db.execute('UPDATE users SET password = ? WHERE login = ?', (password_hash, login))
+
+    async def find_users(self, query, limit, after=None):
+        return self.db.execute(
+            "SELECT login FROM users WHERE login LIKE ? ESCAPE '\\' AND login > ? ORDER BY login LIMIT ?",
+            (escape_like(query) + '%', after or '', limit)
+        ).fetchall()
+
+    async def find_similar_users(self, query, limit, after=None):
+        rows = self.db.execute(
+            "SELECT login, similarity(login, ?) AS rank FROM users WHERE login LIKE ? ESCAPE '\\'"
+            " ORDER BY rank DESC, login",
+            (query, '%' + escape_like(query) + '%')
+        ).fetchall()
+        if after is not None:
+            # Keyset order is rank descending, then login ascending.
+            rows = [r for r in rows if r['rank'] < after[0] or
+                    (r['rank'] == after[0] and r['login'] > after[1])]
+        return rows[:limit]
+
+    async def add_token(self, login, token):
+        with self.db:
+            self.db.execute('UPDATE users SET token = ? WHERE login = ?', (token, login))
+
+    async def get_token(self, login):
+        row = self.db.execute('SELECT token FROM users WHERE login = ?', (login,)).fetchone()
+        return row[0] if row else None
+
+    async def remove_token(self, token):
+        with self.db:
+            self.db.execute('UPDATE users SET token = NULL WHERE token = ?', (token,))
+
+    async def get_friends(self, login):
+        return self.db.execute(
+            'SELECT b.login FROM users a'
+            ' JOIN friendships f ON a.id = f.from_user JOIN users b ON f.to_user = b.id'
+            ' WHERE a.login = ?', (login,)
+        ).fetchall()
+
+    async def add_friendship(self, login, invited):
+        a, b = self._user_id(login), self._user_id(invited)
+        with self.db:
+            self.db.executemany('INSERT INTO friendships(from_user, to_user) VALUES(?, ?)', [(a, b), (b, a)])
+            self._bump('friends_version', (a, b))
+
+    async def get_versions(self, login):
+        row = self.db.execute(
+            'SELECT friends_version, invitations_version FROM users WHERE login = ?', (login,)
+        ).fetchone()
+        return Versions(*row) if row else None
+
+    async def get_invitations(self, login, limit=None, after=None):
+        return self.db.execute(
+            'SELECT b.login FROM users a'
+            ' JOIN invitations i ON a.id = i.from_user JOIN users b ON i.to_user = b.id'
+            ' WHERE a.login = ? AND b.login > ? ORDER BY b.login LIMIT ?',
+            (login, after or '', -1 if limit is None else limit)
+        ).fetchall()
+
+    async def invite(self, login, invited):
+        a, b = self._user_id(login), self._user_id(invited)
+        if b is None:
+            return InviteResult(InviteStatus.UNKNOWN_USER, None)
+
+        friends = self.db.execute(
+            'SELECT 1 FROM friendships WHERE from_user = ? AND to_user = ?', (a, b)
+        ).fetchone()
+        if friends:
+            return InviteResult(InviteStatus.ALREADY_FRIENDS, None)
+
+        with self.db:
+            cur = self.db.executemany(
+                'INSERT OR IGNORE INTO invitations(from_user, to_user) VALUES(?, ?)', [(a, b), (b, a)]
+            )
+            if cur.rowcount:
+                self._bump('invitations_version', (a, b))
+        if not cur.rowcount:
+            return InviteResult(InviteStatus.ALREADY_INVITED, None)
+        return InviteResult(InviteStatus.INVITED, await self.get_token(invited))
+
+    async def answer_invitation(self, login, inviter, accepted):
+        a, b = self._user_id(inviter), self._user_id(login)
+        with self.db:
+            cur = self.db.execute(
+                'DELETE FROM invitations WHERE (from_user = ? AND to_user = ?) OR (from_user = ? AND to_user = ?)',
+                (a, b, b, a)
+            )
+            if not cur.rowcount:
+                return InviteResult(InviteStatus.NO_INVITATION, None)
+            self._bump('invitations_version', (a, b))
+            if accepted:
+                cur = self.db.executemany(
+                    'INSERT OR IGNORE INTO friendships(from_user, to_user) VALUES(?, ?)', [(a, b), (b, a)]
+                )
+                if cur.rowcount:
+                    self._bump('friends_version', (a, b))
+        return InviteResult(InviteStatus.ANSWERED, await self.get_token(inviter))
+
+    async def add_call_records(self, records):
+        rows = [
+            (r.call_id, r.caller, r.callee, r.ring_at.isoformat(), r.answered_at and r.answered_at.isoformat(),
+             r.ended_at.isoformat(), r.duration, r.reason)
+            for r in records
+        ]
+        with self.db:
+            self.db.executemany('INSERT OR IGNORE INTO call_records VALUES(?, ?, ?, ?, ?, ?, ?, ?)', rows)
@@ -0,0 +1,96 @@
+# Compare the storage backends on the hot read paths against [DATABASE] URL:
+#   python -m server.loadtest.storage_bench --iterations 5000 --concurrency 16
+import argparse
+import asyncio
+import random
+import time
+
+from server.main import read_config
+from server.storage import get_schema, get_storage
+
+PREFIX = 'bench-'
+
+
+async def seed(storage, users, friends):
+    # Idempotent, reruns reuse the rows. Login `bench-0` has `friends` friends.
+    async with storage.acquire() as conn:
+        await conn.execute(
+            f"INSERT INTO users (login, password) SELECT '{PREFIX}' || i, 'x' FROM generate_series(0, {users - 1}) i "
+            "ON CONFLICT (login) DO NOTHING"
+        )
+        await conn.execute(
+            'INSERT INTO friendships (from_user, to_user) '
+            f'SELECT a.id, b.id FROM users a, users b, generate_series(1, {friends}) i '
+            f"WHERE (a.login = '{PREFIX}0' AND b.login = '{PREFIX}' || i) "
+            f"   OR (b.login = '{PREFIX}0' AND a.login = '{PREFIX}' || i) "
+            'ON CONFLICT DO NOTHING'
+        )
+    return [f'{PREFIX}{i}' for i in range(users)]
+
+
+async def measure(name, operation, iterations, concurrency):
+    latencies = []
+
+    async def worker(n):
+        for _ in range(n):
+            start = time.perf_counter()
+            await operation()
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    share = iterations // concurrency
+    await asyncio.gather(*[worker(share) for _ in range(concurrency)])
+    duration = time.perf_counter() - start
+
+    ordered = sorted(latencies)
+    p50 = ordered[len(ordered) // 2] * 1000
+    p99 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))] * 1000
+    print(f'{name:<24}{len(ordered) / duration:>10.0f}{p50:>10.3f}{p99:>10.3f}')
+
+
+async def bench(config, backend, logins, args):
+    config.read_dict({'DATABASE': {'BACKEND': backend}})
+    storage = await get_storage(config)
+    try:
+        # Warm up the pool and, for asyncpg, the statement caches.
+        for _ in range(args.concurrency):
+            await storage.registered(logins[0])
+            await storage.get_friends(logins[0])
+
+        await measure(f'{backend} registered', lambda: storage.registered(random.choice(logins)),
+                      args.iterations, args.concurrency)
+        await measure(f'{backend} get_friends', lambda: storage.get_friends(logins[0]),
+                      args.iterations, args.concurrency)
+    finally:
+        await storage.close()
+
+
+async def run(args):
+    config = read_config(args.config)
+    config.read_dict({'DATABASE': {'POOL MAX': str(args.concurrency)}})
+
+    storage = await get_storage(config)
+    try:
+        await storage.create_schema(get_schema(config))
+        logins = await seed(storage, args.users, args.friends)
+    finally:
+        await storage.close()
+
+    print(f'{"operation":<24}{"ops/s":>10}{"p50 ms":>10}{"p99 ms":>10}')
+    for backend in args.backends:
+        await bench(config, backend, logins, args)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', default='config.ini')
+    parser.add_argument('--iterations', type=int, default=5000)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--friends', type=int, default=50)
+    parser.add_argument('--backends', nargs='+', choices=['aiopg', 'asyncpg'], default=['aiopg', 'asyncpg'])
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    asyncio.run(run(parse_args()))
@@ -0,0 +1,88 @@
+import atexit
+import logging
+import queue
+import sys
+import time
+from logging.handlers import QueueHandler, QueueListener
+
+
+class LazyQueueHandler(QueueHandler):
+    # Unlike QueueHandler, leave formatting to the listener thread.
+    def prepare(self, record):
+        return record
+
+
+class RateLimitFilter(logging.Filter):
+    """Token bucket per signalling message type, for records logged with extra={'msg_type': ...}."""
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+        self.buckets = {}
+        self.suppressed = {}
+
+    def filter(self, record):
+        msg_type = getattr(record, 'msg_type', None)
+        rate = self.rates.get(msg_type, None)
+        if rate is None:
+            return True
+
+        now = time.monotonic()
+        tokens, last = self.buckets.get(msg_type, (rate, now))
+        tokens = min(rate, tokens + (now - last) * rate)
+
+        if tokens < 1:
+            self.buckets[msg_type] = (tokens, now)
+            self.suppressed[msg_type] = self.suppressed.get(msg_type, 0) + 1
+            return False
+
+        self.buckets[msg_type] = (tokens - 1, now)
+        record.suppressed = self.suppressed.pop(msg_type, 0)
+        return True
+
+
+class TruncatingFormatter(logging.Formatter):
+    def __init__(self, fmt=None, max_length=512):
+        super().__init__(fmt)
+        self.max_length = max_length
+
+    def formatMessage(self, record):
+        message = record.message
+        if self.max_length and len(message) > self.max_length:
+            message = f'{message[:self.max_length]}... ({len(message) - self.max_length} more)'
+        if getattr(record, 'suppressed', 0):
+            message = f'{message} [{record.suppressed} similar suppressed]'
+
+        record.message = message
+        return super().formatMessage(record)
+
+
+def parse_rates(value):
+    # "OFFER=5, ICE_CANDIDATE=20" -> {'OFFER': 5.0, 'ICE_CANDIDATE': 20.0}
+    rates = {}
+    for item in filter(None, (i.strip() for i in value.split(','))):
+        msg_type, rate = item.split('=')
+        rates[msg_type.strip()] = float(rate)
+    return rates
+
+
+def setup_logging(config):
+    level = config.get('LOGGING', 'LEVEL', fallback='INFO')
+    max_length = config.getint('LOGGING', 'MAX LENGTH', fallback=512)
+    rates = parse_rates(config.get('LOGGING', 'RATE LIMITS', fallback=''))
+
+    # Records are handed over to a thread, stdout I/O stays off the event loop.
+    stream = logging.StreamHandler(sys.stdout)
+    stream.setFormatter(TruncatingFormatter('%(asctime)s %(levelname)s %(message)s', max_length))
+
+    handler = LazyQueueHandler(queue.SimpleQueue())
+    handler.addFilter(RateLimitFilter(rates))
+
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(level)
+
+    listener = QueueListener(handler.queue, stream, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
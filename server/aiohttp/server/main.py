@@ -1,41 +1,105 @@
+import bisect
 import configparser
-import json
+import fernet
+import hashlib
 import logging
 import aiohttp
-import sys
+import math
+import multiprocessing
+import random
 from aiohttp import web
 from aiohttp_security import (
     remember, forget, check_authorized,
     authorized_userid
 )
 
-from server.auth import check_credentials, setup_auth
-from server.notifications import *
+from server.auth import setup_auth
+from server.bus import UnixBus, run_hub
+from server.drain import setup_drain
+from server.envelope import PROTOCOLS, get_codec
+from server.friends import setup_friends
+from server.limits import REJECTED, setup_limits
+from server.log import setup_logging
+from server.metrics import REGISTRY
+from server.notifications import setup_notifications
+from server.search import InvalidCursor, decode_cursor, encode_cursor, setup_search
 from server.call import ClientEndpoint, setup_server
-from server.storage import setup_db
+from server.storage import InviteStatus, Versions, setup_db
 
-logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
 routes = web.RouteTableDef()
 
+INVITE_ERRORS = {
+    InviteStatus.UNKNOWN_USER: web.HTTPBadRequest,
+    InviteStatus.ALREADY_FRIENDS: web.HTTPBadRequest,
+    InviteStatus.ALREADY_INVITED: web.HTTPBadRequest,
+    InviteStatus.NO_INVITATION: web.HTTPNotFound,
+}
+
+# Friend and invitation lists are only paginated when asked to.
+MAX_PAGE_SIZE = 500
+
+
+def list_etag(kind, login, version):
+    # Versions are per user, the login keeps another account's tag from matching after a re-login.
+    user = hashlib.sha256(login.encode()).hexdigest()[:16]
+    return f'W/"{kind}-{user}-{version}"'
+
+
+def etag_matches(request, etag):
+    tags = [tag.strip() for tag in request.headers.get('If-None-Match', '').split(',')]
+    return etag in tags or '*' in tags
+
+
+def page_params(request):
+    # (after, limit), the cursor is the last login of the previous page.
+    params = request.rel_url.query
+    try:
+        limit = min(int(params['limit']), MAX_PAGE_SIZE) if 'limit' in params else None
+    except ValueError:
+        raise web.HTTPBadRequest()
+    if limit is not None and limit < 1:
+        raise web.HTTPBadRequest()
+
+    after = None
+    if 'cursor' in params:
+        after = decode_cursor(params['cursor'])
+        if not isinstance(after, str):
+            raise web.HTTPBadRequest()
+    return after, limit
+
+
+def list_response(logins, etag, limit):
+    headers = {'ETag': etag, 'Vary': 'Cookie'}
+    if limit is not None and len(logins) > limit:
+        logins = logins[:limit]
+        headers['X-Next-Cursor'] = encode_cursor(logins[-1])
+
+    data = [{'login': login} for login in logins]
+    return web.json_response(data, headers=headers)
+
 
 @routes.get('/')
 async def websocket_handler(request):
-    ws = web.WebSocketResponse()
+    ws = web.WebSocketResponse(protocols=PROTOCOLS)
     await ws.prepare(request)
 
-    logging.info('Connected...')
-
     server = request.app['server']
+    if server.draining:
+        # Upgraded just before the listener closed.
+        await ws.close(code=aiohttp.WSCloseCode.SERVICE_RESTART)
+        return ws
+
+    # Envelope version is negotiated with the subprotocol, none means legacy.
+    codec = get_codec(ws.ws_protocol)
+    logging.info('Connected (%s)...', ws.ws_protocol or 'legacy')
+
     # TODO: nick and token should be in place (login)
-    endpoint = ClientEndpoint(socket=ws, server=server)
+    endpoint = ClientEndpoint(socket=ws, server=server, codec=codec)
 
     try:
         async for msg in ws:
-            if msg.type == aiohttp.WSMsgType.TEXT:
-                msg_str = msg.json()
-                msg_obj = json.loads(msg_str)
-                msg_type = msg_obj['type']
-                payload = json.loads(msg_obj['payload'])
+            if msg.type == codec.frame:
+                msg_type, payload = codec.decode(msg.data)
                 await endpoint.dispatch(msg_type, payload)
 
             elif msg.type == aiohttp.WSMsgType.CLOSED:
@@ -44,7 +108,7 @@ async def websocket_handler(request):
                 break
 
             elif msg.type == aiohttp.WSMsgType.ERROR:
-                logging.error('WebSocket connection closed with exception {}'.format(ws.exception()))
+                logging.error('WebSocket connection closed with exception %s', ws.exception())
                 await ws.close()
                 break
 
@@ -54,7 +118,13 @@ async def websocket_handler(request):
     finally:
         logging.info('Websocket connection closed')
 
-    server.rm_client(client=endpoint)  # TODO: conversation cleanup? maybe when all parties leave...
+    try:
+        await endpoint.on_disconnect()
+    except Exception as e:
+        logging.error('Call cleanup of %s failed: %r', endpoint.nick, e)
+
+    endpoint.close()
+    await server.rm_client(client=endpoint)
     return ws
 
 
@@ -78,9 +148,16 @@ async def handle_login(request):
     except KeyError:
         raise web.HTTPBadRequest()
 
-    logging.info("LOGIN: {}".format(login))
+    logging.info("LOGIN: %s", login)
+    admission = request.app['logins']
+    if not admission.take():
+        # Jittered, rejected clients must not come back in lockstep.
+        retry_after = math.ceil(admission.delay() + random.uniform(0, 5))
+        REJECTED.labels('/login', 'admission').inc()
+        raise web.HTTPServiceUnavailable(headers={'Retry-After': str(retry_after)})
+
     storage = request.app['storage']
-    if await check_credentials(storage, login, pwd):
+    if await request.app['passwords'].check_credentials(storage, login, pwd):
         response = web.HTTPOk()
         await remember(request, response, login)
         raise response
@@ -93,13 +170,40 @@ async def handle_get_friends(request):
     await check_authorized(request)
     login = await authorized_userid(request)
 
-    logging.info("GET FRIENDS FOR: {} from {}".format(login, login))
+    logging.info("GET FRIENDS FOR: %s from %s", login, login)
+
+    # A cheap version lookup answers most polls, the URL identifies the page.
+    versions = await request.app['storage'].get_versions(login) or Versions(0, 0)
+    etag = list_etag('friends', login, versions.friends)
+    if etag_matches(request, etag):
+        raise web.HTTPNotModified(headers={'ETag': etag, 'Vary': 'Cookie'})
+
+    after, limit = page_params(request)
+    friends = sorted(await request.app['friends'].friends(login, versions.friends))
+    if after is not None:
+        friends = friends[bisect.bisect_right(friends, after):]
+
+    return list_response(friends, etag, limit)
+
+
+@routes.get('/invitations')
+async def handle_get_invitations(request):
+    await check_authorized(request)
+    login = await authorized_userid(request)
+
+    logging.info("GET INVITATIONS FOR: %s", login)
 
     storage = request.app['storage']
-    users = await storage.get_friends(login)
+    versions = await storage.get_versions(login) or Versions(0, 0)
+    etag = list_etag('invitations', login, versions.invitations)
+    if etag_matches(request, etag):
+        raise web.HTTPNotModified(headers={'ETag': etag, 'Vary': 'Cookie'})
+
+    # Both directions are stored, this lists everyone with a pending invitation either way.
+    after, limit = page_params(request)
+    rows = await storage.get_invitations(login, limit + 1 if limit is not None else None, after)
 
-    data = [{'login': user[0]} for user in users]
-    return web.json_response(data)
+    return list_response([row[0] for row in rows], etag, limit)
 
 
 @routes.get('/users/search')
@@ -107,14 +211,26 @@ async def handle_search(request):
     await check_authorized(request)
     login = await authorized_userid(request)
 
-    query = request.rel_url.query['query']
-    logging.info("SEARCH: {} from {}".format(query, login))
+    params = request.rel_url.query
+    query = params['query']
+    logging.info("SEARCH: %s from %s", query, login)
 
-    storage = request.app['storage']
-    users = await storage.find_users(query)
+    try:
+        limit = int(params['limit']) if 'limit' in params else None
+    except ValueError:
+        raise web.HTTPBadRequest()
+    if limit is not None and limit < 1:
+        raise web.HTTPBadRequest()
 
-    data = [{'login': user[0]} for user in users]
-    return web.json_response(data)
+    try:
+        logins, next_cursor = await request.app['search'].search(query, params.get('cursor'), limit)
+    except InvalidCursor:
+        raise web.HTTPBadRequest()
+
+    # Body stays a plain list for the app, the next page is pointed to by a header.
+    headers = {'X-Next-Cursor': next_cursor} if next_cursor else None
+    data = [{'login': user} for user in logins]
+    return web.json_response(data, headers=headers)
 
 
 @routes.post('/users/invite')
@@ -123,28 +239,20 @@ async def handle_invitation(request):
     login = await authorized_userid(request)
 
     user = await request.json()
-    logging.info("INVITE: {} invites {}".format(login, user['login']))
-
-    storage = request.app['storage']
-
-    # TODO: fewer DB calls? locking?
-    if not await storage.registered(user['login']):
-        return web.HTTPBadRequest()
+    logging.info("INVITE: %s invites %s", login, user['login'])
 
     if user['login'] == login:
         return web.HTTPBadRequest()
 
-    if user['login'] in await storage.get_friends(login):
-        return web.HTTPBadRequest()
-
-    if user['login'] in await storage.get_invitations(login):
+    # Cached, saves the round trip for the common mistake.
+    if await request.app['friends'].are_friends(login, user['login']):
         return web.HTTPBadRequest()
 
-    token = await storage.get_token(user['login'])
-    await push_invitation(token, login)
-
-    await storage.add_invitation(login, user['login'])
+    result = await request.app['storage'].invite(login, user['login'])
+    if result.status in INVITE_ERRORS:
+        return INVITE_ERRORS[result.status]()
 
+    request.app['notifications'].push_invitation(result.token, login)
     return web.Response()
 
 
@@ -156,43 +264,112 @@ async def handle_invitation_answer(request):
     answer = await request.json()
     accepted = answer['positive']
     recipient = answer['to']
-    logging.info("ANSWER INVITATION: {} to {}: {}".format(login, recipient['login'], accepted))
-
-    storage = request.app['storage']
+    logging.info("ANSWER INVITATION: %s to %s: %s", login, recipient['login'], accepted)
 
     # NOTE: could change status only (invitation history)
-    await storage.remove_invitation(recipient['login'], login)
+    result = await request.app['storage'].answer_invitation(login, recipient['login'], bool(accepted))
+    if result.status in INVITE_ERRORS:
+        return INVITE_ERRORS[result.status]()
 
     if accepted:
-        await storage.add_friendship(recipient['login'], login)
+        await request.app['friends'].on_friendship(recipient['login'], login)
 
-    token = await storage.get_token(recipient['login'])
-    await push_invitation_answer(token, login, str(accepted))
+    request.app['notifications'].push_invitation_answer(result.token, login, str(accepted))
 
     return web.Response()
 
 
+@routes.get('/metrics')
+async def handle_metrics(request):
+    # Per process, in sharded mode a scrape sees the worker it landed on.
+    return web.Response(text=REGISTRY.render(), headers={'Content-Type': 'text/plain; version=0.0.4'})
+
+
 @routes.post('/logout')
 async def handle_logout(request):
     logging.info("LOGOUT")
+    login = await authorized_userid(request)
+    if login is not None:
+        request.app['identities'].invalidate(login)
+
     response = web.HTTPOk()
     await forget(request, response)
     raise response
 
 
-def main():
+def read_config(path):
     parser = configparser.ConfigParser()
-    parser.read('../config.ini')
+    parser.read(path)
+    return parser
 
+
+def create_app(config, bus=None, storage=None, push_backend=None):
     app = web.Application()
 
-    setup_db(app, parser)
-    setup_notifications(parser)
-    setup_auth(app)
-    setup_server(app)
+    if storage is None:
+        setup_db(app, config)
+    else:
+        app['storage'] = storage
+    setup_notifications(app, config, push_backend)
+    setup_auth(app, config)
+    setup_friends(app, config)
+    setup_search(app, config)
+    setup_server(app, config, bus)
+    setup_drain(app, config)
+    setup_limits(app, config)
 
     app.add_routes(routes)
-    web.run_app(app, host='192.168.100.106', port=5000)
+    return app
+
+
+def run_worker(config_path, bus_path=None, secret_key=None):
+    config = read_config(config_path)
+    if secret_key is not None:
+        config.read_dict({'AUTH': {'SECRET KEY': secret_key}})
+    setup_logging(config)
+    bus = UnixBus(bus_path) if bus_path else None
+
+    app = create_app(config, bus)
+    web.run_app(
+        app,
+        host=config.get('SERVER', 'HOST', fallback='192.168.100.106'),
+        port=config.getint('SERVER', 'PORT', fallback=5000),
+        reuse_port=bus is not None
+    )
+
+
+def run_sharded(config_path, workers):
+    # Workers share the port, the hub routes signalling between them.
+    config = read_config(config_path)
+    bus_path = config.get('SERVER', 'BUS PATH', fallback='/tmp/deep_noise-bus.sock')
+
+    # Sessions must be readable by whichever worker gets the next request.
+    secret_key = config.get('AUTH', 'SECRET KEY', fallback=None) or fernet.Fernet.generate_key().decode()
+
+    processes = [multiprocessing.Process(target=run_hub, args=(bus_path,), name='bus-hub')]
+    processes += [
+        multiprocessing.Process(target=run_worker, args=(config_path, bus_path, secret_key), name=f'worker-{i}')
+        for i in range(workers)
+    ]
+
+    for p in processes:
+        p.start()
+    try:
+        for p in processes:
+            p.join()
+    finally:
+        for p in processes:
+            p.terminate()
+
+
+def main():
+    config_path = '../config.ini'
+    workers = read_config(config_path).getint('SERVER', 'WORKERS', fallback=1)
+
+    if workers > 1:
+        run_sharded(config_path, workers)
+    else:
+        run_worker(config_path)
 
 
 if __name__ == '__main__':
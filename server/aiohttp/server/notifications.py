@@ -1,39 +1,252 @@
 import asyncio
 import logging
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 import firebase_admin
-from firebase_admin import credentials, messaging
+from firebase_admin import credentials, exceptions, messaging
 
-__all__ = ['push_incoming_call', 'push_invitation', 'push_invitation_answer', 'setup_notifications']
+from server.metrics import Counter, Gauge, Histogram
 
+__all__ = ['Dispatcher', 'FCMBackend', 'FakeBackend', 'setup_notifications']
 
-async def notify(token, payload):
-    message = messaging.Message(
-        data=payload,
-        token=token
-    )
+# Per-message outcome reported by backends.
+SENT = 'SENT'
+INVALID = 'INVALID'
+RETRY = 'RETRY'
+FAILED = 'FAILED'
 
-    loop = asyncio.get_running_loop()
-    await loop.run_in_executor(
-        None, lambda: messaging.send(message)
-    )
-    logging.info('Notified!')
+PUSH_LATENCY = Histogram('deepnoise_push_batch_seconds', 'Time to send one batch of pushes.')
+PUSH_OUTCOMES = Counter('deepnoise_pushes_total', 'Push notifications sent, by outcome.', ['outcome'])
+PUSH_QUEUE = Gauge('deepnoise_push_queue_depth', 'Pushes waiting to be sent.')
+
+
+class FCMBackend:
+    # FCM limit for a single batch request.
+    max_batch = 500
+
+    def __init__(self, config):
+        cred = credentials.Certificate(config.get('GOOGLE CREDENTIALS', 'PATH'))
+        firebase_admin.initialize_app(cred)
+
+    def send(self, entries):
+        messages = [messaging.Message(data=e.payload, token=e.token) for e in entries]
+        batch = messaging.send_each(messages)
+        return [self.outcome(r) for r in batch.responses]
+
+    @staticmethod
+    def outcome(response):
+        if response.success:
+            return SENT
+
+        e = response.exception
+        if isinstance(e, (messaging.UnregisteredError, messaging.SenderIdMismatchError,
+                          exceptions.InvalidArgumentError)):
+            return INVALID
+        if isinstance(e, (messaging.QuotaExceededError, exceptions.UnavailableError,
+                          exceptions.InternalError, exceptions.DeadlineExceededError)):
+            return RETRY
+        logging.error('Push failed: %r', e)
+        return FAILED
+
+
+class FakeBackend:
+    """In-process stand-in for FCM, for offline load testing."""
+    max_batch = 500
+
+    def __init__(self, latency=0.0, failure_rate=0.0, invalid_tokens=()):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.invalid_tokens = set(invalid_tokens)
+        self.sent = []
+        self.batches = 0
+
+    def send(self, entries):
+        time.sleep(self.latency)
+        self.batches += 1
+
+        outcomes = []
+        for e in entries:
+            if e.token in self.invalid_tokens:
+                outcomes.append(INVALID)
+            elif random.random() < self.failure_rate:
+                outcomes.append(RETRY)
+            else:
+                self.sent.append((e.token, e.payload))
+                outcomes.append(SENT)
+        return outcomes
+
+
+class Push:
+    __slots__ = ('token', 'payload', 'attempt')
+
+    def __init__(self, token, payload):
+        self.token = token
+        self.payload = payload
+        self.attempt = 0
+
+
+class Dispatcher:
+    """Queues pushes and sends them in batches from a dedicated, bounded thread pool."""
+
+    def __init__(self, backend, batch_size=100, batch_delay=0.05, pool_size=4,
+                 queue_size=10000, max_retries=3, retry_delay=0.5):
+        self.backend = backend
+        self.batch_size = min(batch_size, backend.max_batch)
+        self.batch_delay = batch_delay
+        self.pool_size = pool_size
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.executor = None
+        self.slots = None
+        self.collector = None
+        self.pending = set()
 
+        # Coroutines called with tokens reported as invalid.
+        self.invalid_token_listeners = []
 
-async def push_incoming_call(token, caller, call_id):
-    payload = {'type': 'INCOMING', 'caller': caller, 'call_id': call_id}
-    await notify(token, payload)
+    @property
+    def queue_depth(self):
+        return self.queue.qsize()
 
+    async def start(self):
+        self.executor = ThreadPoolExecutor(max_workers=self.pool_size, thread_name_prefix='push')
+        self.slots = asyncio.Semaphore(self.pool_size)
+        self.collector = asyncio.create_task(self._collect())
 
-async def push_invitation(token, from_whom):
-    payload = {'type': 'INVITATION', 'from_user': from_whom}
-    await notify(token, payload)
+    async def close(self):
+        self.collector.cancel()
+        for task in list(self.pending):
+            task.cancel()
+        self.executor.shutdown(wait=False)
 
+    def push_incoming_call(self, token, caller, call_id):
+        payload = {'type': 'INCOMING', 'caller': caller, 'call_id': call_id}
+        return self.enqueue(token, payload)
+
+    def push_invitation(self, token, from_whom):
+        payload = {'type': 'INVITATION', 'from_user': from_whom}
+        return self.enqueue(token, payload)
+
+    def push_invitation_answer(self, token, from_whom, positive):
+        payload = {'type': 'INVITATION_ANSWER', 'from_user': from_whom, 'positive': positive}
+        return self.enqueue(token, payload)
+
+    def enqueue(self, token, payload):
+        if not token:
+            logging.error('Push %s dropped: no token', payload['type'])
+            return False
+
+        try:
+            self.queue.put_nowait(Push(token, payload))
+            return True
+        except asyncio.QueueFull:
+            logging.error('Push %s dropped: queue full', payload['type'])
+            return False
+
+    async def _collect(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+
+            # Linger a little to fill the batch.
+            deadline = loop.time() + self.batch_delay
+            while len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            await self.slots.acquire()
+            self._spawn(self._send(batch))
+
+    async def _send(self, batch):
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        try:
+            outcomes = await loop.run_in_executor(self.executor, self.backend.send, batch)
+        except Exception as e:
+            logging.error('Push batch of %d failed: %r', len(batch), e)
+            outcomes = [RETRY] * len(batch)
+        finally:
+            self.slots.release()
+            PUSH_LATENCY.observe(time.perf_counter() - start)
+
+        for outcome in outcomes:
+            PUSH_OUTCOMES.labels(outcome).inc()
+
+        retries = []
+        for entry, outcome in zip(batch, outcomes):
+            if outcome == INVALID:
+                await self._prune(entry.token)
+            elif outcome == RETRY:
+                retries.append(entry)
+
+        sent = outcomes.count(SENT)
+        logging.info('Notified! %d/%d sent, %d to retry', sent, len(batch), len(retries))
+
+        for entry in retries:
+            entry.attempt += 1
+            if entry.attempt > self.max_retries:
+                logging.error('Push %s dropped after %d retries', entry.payload['type'], self.max_retries)
+            else:
+                self._spawn(self._retry(entry))
+
+    async def _retry(self, entry):
+        # Exponential backoff with jitter.
+        delay = self.retry_delay * 2 ** (entry.attempt - 1)
+        await asyncio.sleep(delay * random.uniform(0.5, 1.5))
+        try:
+            self.queue.put_nowait(entry)
+        except asyncio.QueueFull:
+            logging.error('Push %s retry dropped: queue full', entry.payload['type'])
+
+    async def _prune(self, token):
+        logging.info('Pruning invalid push token')
+        for listener in self.invalid_token_listeners:
+            try:
+                await listener(token)
+            except Exception as e:
+                logging.error('Pruning invalid token failed: %r', e)
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self.pending.add(task)
+        task.add_done_callback(self.pending.discard)
+
+
+def get_backend(config):
+    if config.get('NOTIFICATIONS', 'BACKEND', fallback='fcm') == 'fake':
+        return FakeBackend(latency=config.getfloat('NOTIFICATIONS', 'FAKE LATENCY', fallback=0.0))
+    return FCMBackend(config)
+
+
+def setup_notifications(app, config, backend=None):
+    section = 'NOTIFICATIONS'
+    dispatcher = Dispatcher(
+        backend if backend is not None else get_backend(config),
+        batch_size=config.getint(section, 'BATCH SIZE', fallback=100),
+        batch_delay=config.getfloat(section, 'BATCH DELAY', fallback=0.05),
+        pool_size=config.getint(section, 'POOL SIZE', fallback=4),
+        queue_size=config.getint(section, 'QUEUE SIZE', fallback=10000),
+        max_retries=config.getint(section, 'MAX RETRIES', fallback=3),
+        retry_delay=config.getfloat(section, 'RETRY DELAY', fallback=0.5),
+    )
+    app['notifications'] = dispatcher
+    PUSH_QUEUE.set_function(lambda: dispatcher.queue_depth)
 
-async def push_invitation_answer(token, from_whom, positive):
-    payload = {'type': 'INVITATION_ANSWER', 'from_user': from_whom, 'positive': positive}
-    await notify(token, payload)
+    async def _setup(app):
+        dispatcher.invalid_token_listeners.append(app['storage'].remove_token)
+        await dispatcher.start()
 
+    async def _cleanup(app):
+        await dispatcher.close()
 
-def setup_notifications(config):
-    cred = credentials.Certificate(config.get('GOOGLE CREDENTIALS', 'PATH'))
-    firebase_admin.initialize_app(cred)
+    app.on_startup.append(_setup)
+    app.on_cleanup.append(_cleanup)
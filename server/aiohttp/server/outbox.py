@@ -0,0 +1,122 @@
+import asyncio
+import logging
+from collections import deque
+from aiohttp import WSCloseCode
+
+from server.metrics import Counter, Histogram
+
+# On overflow: close the slow consumer, or drop the newest message.
+EVICT = 'evict'
+DROP = 'drop'
+
+# A newer message of these types makes a queued one obsolete (renegotiation).
+SUPERSEDED = {'OFFER', 'ANSWER'}
+
+OUTBOX_MESSAGES = Counter('deepnoise_outbox_messages_total', 'Outbound messages, by outcome.', ['outcome'])
+OUTBOX_MAX_DEPTH = Histogram(
+    'deepnoise_outbox_max_depth', 'Deepest queue of each closed connection.',
+    buckets=(0, 1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024)
+)
+SENT = OUTBOX_MESSAGES.labels('sent')
+DROPPED = OUTBOX_MESSAGES.labels('dropped')
+COALESCED = OUTBOX_MESSAGES.labels('coalesced')
+
+# Eviction closes run detached, referenced until done so they aren't garbage collected.
+_closing = set()
+
+
+class Outbox:
+    """Bounded outbound queue of one connection, drained by its own writer task.
+
+    Most connections sit idle, so the queue is allocated on the first message and the
+    writer task only lives while there is something to send.
+    """
+    __slots__ = ('socket', 'codec', 'size', 'policy', 'send_timeout', 'coalesce',
+                 'queue', 'writer', 'closed', 'max_depth')
+
+    def __init__(self, socket, codec, size=256, policy=EVICT, send_timeout=5.0, coalesce=True):
+        self.socket = socket
+        self.codec = codec
+        self.size = size
+        self.policy = policy
+        self.send_timeout = send_timeout
+        self.coalesce = coalesce
+
+        self.queue = None
+        self.writer = None
+        self.closed = False
+        self.max_depth = 0
+
+    def put(self, type, payload):
+        if self.closed:
+            DROPPED.inc()
+            return False
+
+        if self.queue is None:
+            self.queue = deque()
+
+        if self.coalesce and type in SUPERSEDED:
+            for i, (queued_type, _) in enumerate(self.queue):
+                if queued_type == type:
+                    self.queue[i] = (type, payload)
+                    COALESCED.inc()
+                    return True
+
+        if len(self.queue) >= self.size:
+            if self.policy == DROP:
+                DROPPED.inc()
+                logging.error('Outbox full, dropped %s', type)
+                return False
+
+            logging.error('Outbox full, evicting slow consumer')
+            DROPPED.inc(1 + len(self.queue))
+            self.close(evict=True)
+            return False
+
+        self.queue.append((type, payload))
+        self.max_depth = max(self.max_depth, len(self.queue))
+
+        if self.writer is None:
+            self.writer = asyncio.create_task(self._write())
+        return True
+
+    def close(self, evict=False):
+        if self.closed:
+            return
+        self.closed = True
+        OUTBOX_MAX_DEPTH.observe(self.max_depth)
+        if self.queue is not None:
+            self.queue.clear()
+
+        if self.writer is not None:
+            self.writer.cancel()
+        if evict:
+            task = asyncio.create_task(self.socket.close(code=WSCloseCode.TRY_AGAIN_LATER))
+            _closing.add(task)
+            task.add_done_callback(_closing.discard)
+
+    async def shutdown(self, code, timeout):
+        # Writes what's queued, then closes the socket.
+        if self.writer is not None:
+            await asyncio.wait([self.writer], timeout=timeout)
+        self.close()
+        await self.socket.close(code=code)
+
+    async def _write(self):
+        # Exits once the queue is drained, the next put starts a new writer.
+        try:
+            while self.queue:
+                type, payload = self.queue.popleft()
+                try:
+                    await asyncio.wait_for(self.codec.send(self.socket, type, payload), self.send_timeout)
+                except asyncio.TimeoutError:
+                    logging.error('Send of %s timed out, evicting slow consumer', type)
+                    self.close(evict=True)
+                    return
+                except ConnectionError as e:
+                    logging.error('Send of %s failed: %r', type, e)
+                    self.close()
+                    return
+                SENT.inc()
+        finally:
+            self.writer = None
@@ -0,0 +1,103 @@
+import logging
+
+# To subscribed clients: the friend list, then deltas.
+FRIENDS = 'FRIENDS'
+FRIEND_ADDED = 'FRIEND_ADDED'
+PRESENCE = 'PRESENCE'
+
+# Between workers: asks a friend's worker to report them online.
+PROBE = 'PRESENCE_PROBE'
+
+
+class Presence:
+    """Friend list and online/offline deltas pushed to clients that subscribed to them.
+
+    A worker only knows its own clients, friends connected elsewhere are probed over the bus
+    and report back with PRESENCE. Updates only go to subscribed local clients and to clients
+    of other workers known to be online, not to every friend.
+    """
+
+    def __init__(self, server, friends):
+        self.server = server
+        self.friends = friends
+        # Logins online on other workers, as far as probes and presence updates tell.
+        self.remote = set()
+
+    def online(self, nick):
+        return nick in self.server.clients
+
+    def interested(self, nick):
+        endpoint = self.server.clients.get(nick, None)
+        if endpoint is not None:
+            return endpoint.subscribed
+        return nick in self.remote
+
+    async def subscribe(self, endpoint):
+        endpoint.subscribed = True
+        friends = sorted(await self.friends.friends(endpoint.nick))
+
+        await endpoint.send_msg(FRIENDS, {'friends': [{'login': f, 'online': self.online(f)} for f in friends]})
+        for friend in friends:
+            if not self.online(friend):
+                await self.probe(endpoint.nick, friend)
+
+    async def on_online(self, nick):
+        self.remote.discard(nick)
+        await self.broadcast(nick, {'login': nick, 'online': True})
+
+    async def on_offline(self, nick):
+        await self.broadcast(nick, {'login': nick, 'online': False})
+
+    async def on_friendship(self, login, invited):
+        await self.notify(login, FRIEND_ADDED, {'login': invited, 'online': self.online(invited)})
+        await self.notify(invited, FRIEND_ADDED, {'login': login, 'online': self.online(login)})
+
+    async def on_probe(self, endpoint, sender):
+        self.remote.add(sender)
+        await self.notify(sender, PRESENCE, {'login': endpoint.nick, 'online': True})
+        # The sender may have come online before this worker knew to tell the endpoint.
+        if endpoint.subscribed and sender in await self.friends.friends(endpoint.nick):
+            await endpoint.send_msg(PRESENCE, {'login': sender, 'online': True})
+
+    async def broadcast(self, nick, payload):
+        try:
+            # Copied, the cached set may gain friends while notifications are sent.
+            friends = list(await self.friends.friends(nick))
+        except Exception as e:
+            logging.error('Presence of %s not sent: %r', nick, e)
+            return
+
+        for friend in friends:
+            if self.interested(friend):
+                await self.notify(friend, PRESENCE, payload)
+
+    async def probe(self, nick, friend):
+        if self.server.bus.reachable(friend):
+            await self.server.bus.send(friend, PROBE, {'from': nick})
+
+    async def notify(self, nick, type, payload):
+        endpoint = self.server.clients.get(nick, None)
+        if endpoint is not None:
+            await self.deliver(endpoint, type, payload)
+        elif self.server.bus.reachable(nick):
+            await self.server.bus.send(nick, type, payload)
+
+    async def deliver(self, endpoint, type, payload):
+        login = payload['login']
+        if type == PRESENCE and not self.online(login):
+            if payload['online']:
+                self.remote.add(login)
+            else:
+                self.remote.discard(login)
+
+        if type == FRIEND_ADDED:
+            # Possibly stored by another worker.
+            self.friends.add_edge(endpoint.nick, login)
+
+        if not endpoint.subscribed:
+            return
+        await endpoint.send_msg(type, payload)
+
+        if type == FRIEND_ADDED and not payload['online']:
+            # Offline, or connected to another worker.
+            await self.probe(endpoint.nick, login)
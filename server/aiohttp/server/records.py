@@ -0,0 +1,104 @@
+import asyncio
+import logging
+import time
+from collections import namedtuple
+from datetime import datetime, timezone
+
+from server.metrics import Counter, Histogram
+
+# Why a call ended.
+HANGUP = 'HANGUP'
+CANCELLED = 'CANCELLED'
+REFUSED = 'REFUSED'
+NO_ANSWER = 'NO_ANSWER'
+SIGNALLING_TIMEOUT = 'SIGNALLING_TIMEOUT'
+
+RECORDS_FLUSH = Histogram('deepnoise_call_records_flush_seconds', 'Time to write one batch of call records.')
+RECORDS_DROPPED = Counter('deepnoise_call_records_dropped_total', 'Call records lost to a full buffer.')
+
+# Duration is the talk time in seconds, None for calls never answered.
+CallRecord = namedtuple(
+    'CallRecord', ['call_id', 'caller', 'callee', 'ring_at', 'answered_at', 'ended_at', 'duration', 'reason']
+)
+
+
+def utc(timestamp):
+    return datetime.fromtimestamp(timestamp, timezone.utc) if timestamp is not None else None
+
+
+class CallRecorder:
+    """Write-behind buffer of call records, flushed in multi-row inserts off the signalling path."""
+
+    def __init__(self, storage, flush_size=500, flush_interval=1.0, max_pending=50000):
+        self.storage = storage
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+
+        self.pending = []
+        self.wakeup = None
+        self.task = None
+        self.closed = False
+
+    async def start(self):
+        self.wakeup = asyncio.Event()
+        self.task = asyncio.create_task(self._run())
+
+    async def close(self):
+        # Not cancelled, a batch being written must not be lost.
+        self.closed = True
+        if self.task is not None:
+            self.wakeup.set()
+            await self.task
+        await self.flush()
+
+    def record(self, conversation, reason):
+        # Conversation times are monotonic, the record gets wall clock ones.
+        now, ended = time.monotonic(), time.time()
+        ring_at = ended - (now - conversation.started)
+        answered_at = duration = None
+        if conversation.answered is not None:
+            answered_at = ring_at + (conversation.answered - conversation.started)
+            duration = now - conversation.answered
+
+        self.add(CallRecord(
+            conversation.uid, conversation.caller, conversation.callee,
+            utc(ring_at), utc(answered_at), utc(ended), duration, reason
+        ))
+
+    def add(self, record):
+        if len(self.pending) >= self.max_pending:
+            # DB down for long, the oldest records go first.
+            self.pending.pop(0)
+            RECORDS_DROPPED.inc()
+        self.pending.append(record)
+
+        if len(self.pending) >= self.flush_size and self.wakeup is not None:
+            self.wakeup.set()
+
+    async def flush(self):
+        while self.pending:
+            batch, self.pending = self.pending[:self.flush_size], self.pending[self.flush_size:]
+            start = time.perf_counter()
+            try:
+                await self.storage.add_call_records(batch)
+            except Exception as e:
+                logging.error('Writing %d call records failed: %r', len(batch), e)
+                # Kept for the next flush, inserts skip records already written.
+                self.pending = batch + self.pending
+                overflow = len(self.pending) - self.max_pending
+                if overflow > 0:
+                    del self.pending[:overflow]
+                    RECORDS_DROPPED.inc(overflow)
+                return
+            finally:
+                RECORDS_FLUSH.observe(time.perf_counter() - start)
+
+    async def _run(self):
+        while not self.closed:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            await self.flush()
@@ -0,0 +1,96 @@
+import base64
+import json
+import time
+from collections import OrderedDict
+
+
+def encode_cursor(value):
+    return base64.urlsafe_b64encode(json.dumps(value).encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        return json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except ValueError:
+        return None
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def is_rank_cursor(after):
+    # [rank, login] of the last row of a trigram page.
+    return (
+        isinstance(after, list) and len(after) == 2
+        and isinstance(after[0], (int, float)) and not isinstance(after[0], bool)
+        and isinstance(after[1], str)
+    )
+
+
+class UserSearch:
+    """Paginated login search with a short-lived cache for hot prefixes."""
+
+    # Trigrams of shorter queries match almost everything, prefix search is both faster and better.
+    min_trigram_query = 3
+
+    def __init__(self, storage, mode='prefix', limit=20, max_limit=50, cache_ttl=5, cache_size=10000):
+        self.storage = storage
+        self.mode = mode
+        self.limit = limit
+        self.max_limit = max_limit
+        self.cache_ttl = cache_ttl
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+
+    async def search(self, query, cursor=None, limit=None):
+        limit = min(limit or self.limit, self.max_limit)
+        key = (query, cursor, limit)
+
+        entry = self.cache.get(key, None)
+        if entry is not None and entry[0] > time.monotonic():
+            return entry[1]
+
+        result = await self._search(query, cursor, limit)
+
+        self.cache[key] = (time.monotonic() + self.cache_ttl, result)
+        self.cache.move_to_end(key)
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+        return result
+
+    async def _search(self, query, cursor, limit):
+        after = decode_cursor(cursor) if cursor else None
+        if cursor and after is None:
+            raise InvalidCursor(cursor)
+
+        # Fetch one more row to know whether there is a next page.
+        if self.mode == 'trigram' and len(query) >= self.min_trigram_query:
+            if after is not None and not is_rank_cursor(after):
+                raise InvalidCursor(cursor)
+            rows = await self.storage.find_similar_users(query, limit + 1, after)
+            next_after = [rows[limit - 1]['rank'], rows[limit - 1]['login']] if len(rows) > limit else None
+        else:
+            if after is not None and not isinstance(after, str):
+                raise InvalidCursor(cursor)
+            rows = await self.storage.find_users(query, limit + 1, after)
+            next_after = rows[limit - 1]['login'] if len(rows) > limit else None
+
+        logins = [row['login'] for row in rows[:limit]]
+        next_cursor = encode_cursor(next_after) if next_after is not None else None
+        return logins, next_cursor
+
+
+def setup_search(app, config):
+    async def _setup(app):
+        app['search'] = UserSearch(
+            app['storage'],
+            mode=config.get('SEARCH', 'MODE', fallback='prefix'),
+            limit=config.getint('SEARCH', 'LIMIT', fallback=20),
+            max_limit=config.getint('SEARCH', 'MAX LIMIT', fallback=50),
+            cache_ttl=config.getfloat('SEARCH', 'CACHE TTL', fallback=5),
+            cache_size=config.getint('SEARCH', 'CACHE SIZE', fallback=10000),
+        )
+
+    app.on_startup.append(_setup)
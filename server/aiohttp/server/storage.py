@@ -1,6 +1,20 @@
 import aiopg.sa as aiosa
+import enum
 import re
 import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import insert
+import time
+from collections import namedtuple
+from contextlib import asynccontextmanager
+
+from server.metrics import Histogram
+
+try:
+    import asyncpg
+except ImportError:
+    asyncpg = None
+
+POOL_WAIT = Histogram('deepnoise_db_pool_wait_seconds', 'Time spent waiting for a pooled DB connection.')
 
 meta = sa.MetaData()
 users = sa.Table(
@@ -9,6 +23,8 @@ users = sa.Table(
     sa.Column('login', sa.String(100), unique=True, nullable=False),
     sa.Column('password', sa.String(100), nullable=False),
     sa.Column('token', sa.String(4096), nullable=False),
+    sa.Column('friends_version', sa.Integer, nullable=False),
+    sa.Column('invitations_version', sa.Integer, nullable=False),
 )
 
 invitations = sa.Table(
@@ -27,11 +43,30 @@ friendships = sa.Table(
     sa.UniqueConstraint('from_user', 'to_user')
 )
 
+call_records = sa.Table(
+    'call_records', meta,
+    sa.Column('call_id', sa.String(36), primary_key=True),
+    sa.Column('caller', sa.String(100), nullable=False),
+    sa.Column('callee', sa.String(100), nullable=False),
+    sa.Column('ring_at', sa.DateTime(timezone=True), nullable=False),
+    sa.Column('answered_at', sa.DateTime(timezone=True)),
+    sa.Column('ended_at', sa.DateTime(timezone=True), nullable=False),
+    sa.Column('duration', sa.Float),
+    sa.Column('end_reason', sa.String(20), nullable=False),
+)
+
 create_user_table = ('CREATE TABLE IF NOT EXISTS users('
                      'id SERIAL PRIMARY KEY, '
                      'login VARCHAR (100) UNIQUE NOT NULL, '
                      'password VARCHAR (100) NOT NULL, '
-                     'token VARCHAR (4096));')
+                     'token VARCHAR (4096), '
+                     'friends_version INTEGER NOT NULL DEFAULT 0, '
+                     'invitations_version INTEGER NOT NULL DEFAULT 0);')
+
+# Bumped with every write to the user's friends or invitations, they make the ETags.
+add_version_columns = ('ALTER TABLE users '
+                       'ADD COLUMN IF NOT EXISTS friends_version INTEGER NOT NULL DEFAULT 0, '
+                       'ADD COLUMN IF NOT EXISTS invitations_version INTEGER NOT NULL DEFAULT 0;')
 
 create_invitation_table = ('CREATE TABLE IF NOT EXISTS invitations('
                            'id SERIAL PRIMARY KEY, '
@@ -45,8 +80,166 @@ create_friendship_table = ('CREATE TABLE IF NOT EXISTS friendships('
                            'to_user INTEGER REFERENCES users(id), '
                            'UNIQUE (from_user, to_user));')
 
+create_call_record_table = ('CREATE TABLE IF NOT EXISTS call_records('
+                            'call_id VARCHAR (36) PRIMARY KEY, '
+                            'caller VARCHAR (100) NOT NULL, '
+                            'callee VARCHAR (100) NOT NULL, '
+                            'ring_at TIMESTAMPTZ NOT NULL, '
+                            'answered_at TIMESTAMPTZ, '
+                            'ended_at TIMESTAMPTZ NOT NULL, '
+                            'duration DOUBLE PRECISION, '
+                            'end_reason VARCHAR (20) NOT NULL);')
+
+create_login_prefix_index = 'CREATE INDEX IF NOT EXISTS users_login_prefix ON users (login text_pattern_ops);'
+create_trgm_extension = 'CREATE EXTENSION IF NOT EXISTS pg_trgm;'
+create_login_trgm_index = 'CREATE INDEX IF NOT EXISTS users_login_trgm ON users USING gin (login gin_trgm_ops);'
+
+# In the order of server.records.CallRecord.
+call_record_columns = ['call_id', 'caller', 'callee', 'ring_at', 'answered_at', 'ended_at', 'duration', 'end_reason']
+
+# Both directions are stored for invitations and friendships. Rows are inserted in
+# a fixed order so that concurrent mutual invites can't deadlock.
+invite_sql = (
+    'WITH parties AS ('
+    '  SELECT (SELECT id FROM users WHERE login = :login) AS from_id, u.id AS to_id, u.token,'
+    '         EXISTS (SELECT 1 FROM friendships f'
+    '                 WHERE f.from_user = (SELECT id FROM users WHERE login = :login)'
+    '                   AND f.to_user = u.id) AS friends'
+    '  FROM users u WHERE u.login = :invited'
+    '), inserted AS ('
+    '  INSERT INTO invitations (from_user, to_user)'
+    '  SELECT a, b FROM ('
+    '    SELECT from_id AS a, to_id AS b FROM parties WHERE NOT friends'
+    '    UNION ALL'
+    '    SELECT to_id, from_id FROM parties WHERE NOT friends'
+    '  ) pairs ORDER BY a, b'
+    '  ON CONFLICT DO NOTHING'
+    '  RETURNING id'
+    '), bumped AS ('
+    '  UPDATE users SET invitations_version = invitations_version + 1'
+    '  WHERE id IN (SELECT from_id FROM parties UNION ALL SELECT to_id FROM parties)'
+    '    AND EXISTS (SELECT 1 FROM inserted)'
+    '  RETURNING id'
+    ')'
+    'SELECT p.friends, p.token, (SELECT count(*) FROM inserted) AS inserted FROM parties p'
+)
+
+answer_sql = (
+    'WITH parties AS ('
+    '  SELECT (SELECT id FROM users WHERE login = :inviter) AS inviter_id,'
+    '         (SELECT id FROM users WHERE login = :login) AS invitee_id'
+    '), removed AS ('
+    '  DELETE FROM invitations i USING parties p'
+    '  WHERE (i.from_user = p.inviter_id AND i.to_user = p.invitee_id)'
+    '     OR (i.from_user = p.invitee_id AND i.to_user = p.inviter_id)'
+    '  RETURNING i.id'
+    '), befriended AS ('
+    '  INSERT INTO friendships (from_user, to_user)'
+    '  SELECT a, b FROM ('
+    '    SELECT inviter_id AS a, invitee_id AS b FROM parties'
+    '    UNION ALL'
+    '    SELECT invitee_id, inviter_id FROM parties'
+    '  ) pairs WHERE :accepted AND EXISTS (SELECT 1 FROM removed) ORDER BY a, b'
+    '  ON CONFLICT DO NOTHING'
+    '  RETURNING id'
+    '), bumped AS ('
+    '  UPDATE users u SET invitations_version = u.invitations_version + 1,'
+    '         friends_version = u.friends_version +'
+    '           CASE WHEN EXISTS (SELECT 1 FROM befriended) THEN 1 ELSE 0 END'
+    '  FROM parties p WHERE u.id IN (p.inviter_id, p.invitee_id) AND EXISTS (SELECT 1 FROM removed)'
+    '  RETURNING u.id'
+    ')'
+    'SELECT (SELECT count(*) FROM removed) AS removed,'
+    '       (SELECT token FROM users WHERE login = :inviter) AS token'
+)
+
+invite_query = sa.text(invite_sql)
+answer_query = sa.text(answer_sql)
+
+
+class InviteStatus(enum.Enum):
+    INVITED = 'INVITED'
+    UNKNOWN_USER = 'UNKNOWN_USER'
+    ALREADY_FRIENDS = 'ALREADY_FRIENDS'
+    ALREADY_INVITED = 'ALREADY_INVITED'
+    ANSWERED = 'ANSWERED'
+    NO_INVITATION = 'NO_INVITATION'
+
+
+# Token of the other party, to push the news to.
+InviteResult = namedtuple('InviteResult', ['status', 'token'])
+
+Versions = namedtuple('Versions', ['friends', 'invitations'])
+
+
+def escape_like(query):
+    return re.sub(r'([%_\\])', r'\\\1', query)
+
+
+class Storage:
+    """Persistence interface used by the handlers, implemented per database driver."""
+
+    async def close(self):
+        raise NotImplementedError
+
+    async def create_schema(self, statements):
+        raise NotImplementedError
+
+    async def registered(self, login):
+        raise NotImplementedError
+
+    async def get_hash(self, login):
+        raise NotImplementedError
+
+    async def set_hash(self, login, password_hash):
+        raise NotImplementedError
+
+    async def find_users(self, query, limit, after=None):
+        raise NotImplementedError
+
+    async def find_similar_users(self, query, limit, after=None):
+        raise NotImplementedError
+
+    async def add_token(self, login, token):
+        raise NotImplementedError
+
+    async def get_token(self, login):
+        raise NotImplementedError
+
+    async def remove_token(self, token):
+        raise NotImplementedError
+
+    async def get_friends(self, login):
+        raise NotImplementedError
+
+    async def add_friendship(self, login, invited):
+        raise NotImplementedError
+
+    async def get_versions(self, login):
+        raise NotImplementedError
+
+    async def get_invitations(self, login, limit=None, after=None):
+        raise NotImplementedError
+
+    async def add_invitation(self, login, invited):
+        raise NotImplementedError
+
+    async def invite(self, login, invited):
+        raise NotImplementedError
+
+    async def answer_invitation(self, login, inviter, accepted):
+        raise NotImplementedError
+
+    async def remove_invitation(self, login, invited):
+        raise NotImplementedError
+
+    async def add_call_records(self, records):
+        raise NotImplementedError
+
+
+class DBStorage(Storage):
+    """aiopg backend, queries are built with SQLAlchemy Core."""
 
-class DBStorage:
     def __init__(self, db):
         self.db = db
 
@@ -54,12 +247,24 @@ class DBStorage:
         self.db.close()
         await self.db.wait_closed()
 
+    @asynccontextmanager
+    async def acquire(self):
+        start = time.perf_counter()
+        async with self.db.acquire() as conn:
+            POOL_WAIT.observe(time.perf_counter() - start)
+            yield conn
+
+    async def create_schema(self, statements):
+        async with self.acquire() as conn:
+            for statement in statements:
+                await conn.execute(statement)
+
     ###
     # USERS
     ###
 
     async def registered(self, login):
-        async with self.db.acquire() as conn:
+        async with self.acquire() as conn:
             s_query = users.count().where(users.c.login == login)
             user_res = await conn.scalar(s_query)
             if user_res:
@@ -67,7 +272,7 @@ class DBStorage:
             return False
 
     async def get_hash(self, login):
-        async with self.db.acquire() as conn:
+        async with self.acquire() as conn:
             s_query = users.select().where(users.c.login == login)
             user_res = await conn.execute(s_query)
             if user_res:
@@ -76,16 +281,45 @@ class DBStorage:
                     return user['password']
             return None
 
-    async def find_users(self, query):
-        # Escape wildcards
-        # TODO: maybe allow exact match only?
-        q = re.sub(r'[%_]', '\\\1', query)
-        wildcard_q = '%' + q + '%'
+    async def set_hash(self, login, password_hash):
+        async with self.acquire() as conn:
+            u_query = users.update().where(users.c.login == login).values(password=password_hash)
+            await conn.execute(u_query)
+
+    async def find_users(self, query, limit, after=None):
+        # Prefix match, uses the text_pattern_ops index. Exact match sorts first.
+        pattern = escape_like(query) + '%'
+
+        async with self.acquire() as conn:
+            s_query = sa.select([users.c.login])\
+                .where(users.c.login.like(pattern, escape='\\'))\
+                .order_by(users.c.login)\
+                .limit(limit)
+            if after is not None:
+                s_query = s_query.where(users.c.login > after)
 
-        async with self.db.acquire() as conn:
-            s_query = sa.select([users.c.login]).where(users.c.login.like(wildcard_q))
             res = await conn.execute(s_query)
+            return await res.fetchall()
 
+    async def find_similar_users(self, query, limit, after=None):
+        # Substring match through the trigram index, best matches first.
+        # `after` is the (rank, login) of the last row of the previous page.
+        pattern = '%' + escape_like(query) + '%'
+        rank = sa.func.similarity(users.c.login, query)
+
+        async with self.acquire() as conn:
+            s_query = sa.select([users.c.login, rank.label('rank')])\
+                .where(users.c.login.ilike(pattern, escape='\\'))\
+                .order_by(rank.desc(), users.c.login)\
+                .limit(limit)
+            if after is not None:
+                last_rank, last_login = after
+                s_query = s_query.where(sa.or_(
+                    rank < last_rank,
+                    sa.and_(rank == last_rank, users.c.login > last_login)
+                ))
+
+            res = await conn.execute(s_query)
             return await res.fetchall()
 
     ###
@@ -93,31 +327,29 @@ class DBStorage:
     ###
 
     async def add_token(self, login, token):
-        async with self.db.acquire() as conn:
+        async with self.acquire() as conn:
             i_query = users.update().where(users.c.login == login).values(token=token)
             await conn.execute(i_query)
 
-    async def get_tokens(self):
-        async with self.db.acquire() as conn:
-            s_query = sa.select([users.c.login, users.c.token])
-            res = await conn.execute(s_query)
-
-            return await res.fetchall()
-
     async def get_token(self, login):
-        async with self.db.acquire() as conn:
+        async with self.acquire() as conn:
             s_query = sa.select([users.c.token]).where(users.c.login == login)
             res = await conn.execute(s_query)
 
             token = await res.fetchone()
-            return token[0]
+            return token[0] if token else None
+
+    async def remove_token(self, token):
+        async with self.acquire() as conn:
+            u_query = users.update().where(users.c.token == token).values(token=None)
+            await conn.execute(u_query)
 
     ###
     # FRIENDS
     ###
 
     async def get_friends(self, login):
-        async with self.db.acquire() as conn:
+        async with self.acquire() as conn:
             aliased = users.alias()
             joined = users\
                 .join(friendships, users.c.id == friendships.c.from_user)\
@@ -130,7 +362,7 @@ class DBStorage:
             return await res.fetchall()
 
     async def add_friendship(self, login, invited):
-        async with self.db.acquire() as conn:
+        async with self.acquire() as conn:
             s_query = sa\
                 .select([users.c.id, users.c.login])\
                 .where(users.c.login.in_((login, invited)))
@@ -146,22 +378,36 @@ class DBStorage:
             i_query = friendships.insert().values(values)
 
             await conn.execute(i_query)
+            await self._bump(conn, users.c.friends_version, ids)
 
-    async def get_invitations(self, login):
-        async with self.db.acquire() as conn:
+    async def get_versions(self, login):
+        async with self.acquire() as conn:
+            s_query = sa.select([users.c.friends_version, users.c.invitations_version])\
+                .where(users.c.login == login)
+            res = await conn.execute(s_query)
+
+            row = await res.fetchone()
+            return Versions(*row) if row else None
+
+    async def get_invitations(self, login, limit=None, after=None):
+        async with self.acquire() as conn:
             aliased = users.alias()
             joined = users\
                 .join(invitations, users.c.id == invitations.c.from_user)\
                 .join(aliased, invitations.c.to_user == aliased.c.id)
 
             s_query = sa.select([aliased.c.login]).where(users.c.login == login)\
-                .select_from(joined)
+                .select_from(joined)\
+                .order_by(aliased.c.login)\
+                .limit(limit)
+            if after is not None:
+                s_query = s_query.where(aliased.c.login > after)
 
             res = await conn.execute(s_query)
             return await res.fetchall()
 
     async def add_invitation(self, login, invited):
-        async with self.db.acquire() as conn:
+        async with self.acquire() as conn:
             s_query = sa\
                 .select([users.c.id, users.c.login])\
                 .where(users.c.login.in_((login, invited)))
@@ -177,9 +423,33 @@ class DBStorage:
             i_query = invitations.insert().values(values)
 
             await conn.execute(i_query)
+            await self._bump(conn, users.c.invitations_version, ids)
+
+    async def invite(self, login, invited):
+        async with self.acquire() as conn:
+            res = await conn.execute(invite_query.bindparams(login=login, invited=invited))
+            row = await res.fetchone()
+
+            if row is None:
+                return InviteResult(InviteStatus.UNKNOWN_USER, None)
+            if row['friends']:
+                return InviteResult(InviteStatus.ALREADY_FRIENDS, None)
+            if not row['inserted']:
+                return InviteResult(InviteStatus.ALREADY_INVITED, None)
+            return InviteResult(InviteStatus.INVITED, row['token'])
+
+    async def answer_invitation(self, login, inviter, accepted):
+        async with self.acquire() as conn:
+            query = answer_query.bindparams(login=login, inviter=inviter, accepted=accepted)
+            res = await conn.execute(query)
+            row = await res.fetchone()
+
+            if not row['removed']:
+                return InviteResult(InviteStatus.NO_INVITATION, None)
+            return InviteResult(InviteStatus.ANSWERED, row['token'])
 
     async def remove_invitation(self, login, invited):
-        async with self.db.acquire() as conn:
+        async with self.acquire() as conn:
             aliased = users.alias()
             joined = users\
                 .join(invitations, users.c.id == invitations.c.from_user)\
@@ -195,11 +465,266 @@ class DBStorage:
                 .select_from(joined)
 
             d_query = invitations.delete().where(invitations.c.id.in_(s_query))
-            await conn.execute(d_query)
+            res = await conn.execute(d_query)
+
+            if res.rowcount:
+                u_query = users.update()\
+                    .where(users.c.login.in_([login, invited]))\
+                    .values(invitations_version=users.c.invitations_version + 1)
+                await conn.execute(u_query)
+
+    @staticmethod
+    async def _bump(conn, version, ids):
+        u_query = users.update().where(users.c.id.in_(ids)).values({version: version + 1})
+        await conn.execute(u_query)
+
+    ###
+    # CALLS
+    ###
+
+    async def add_call_records(self, records):
+        async with self.acquire() as conn:
+            values = [dict(zip(call_record_columns, record)) for record in records]
+            i_query = insert(call_records).values(values).on_conflict_do_nothing()
+            await conn.execute(i_query)
+
+
+def positional(sql, *names):
+    # asyncpg takes $n parameters, the shared queries use :name (not :: casts).
+    return re.sub(r'(?<![:\w]):(\w+)', lambda m: f'${names.index(m.group(1)) + 1}', sql)
+
+
+class AsyncpgStorage(Storage):
+    """asyncpg backend, plain SQL prepared once per connection and kept in its statement cache."""
+
+    registered_sql = 'SELECT 1 FROM users WHERE login = $1'
+    get_hash_sql = 'SELECT password FROM users WHERE login = $1'
+    set_hash_sql = 'UPDATE users SET password = $2 WHERE login = $1'
+    find_users_sql = (
+        "SELECT login FROM users WHERE login LIKE $1 ESCAPE '\\' ORDER BY login LIMIT $2"
+    )
+    find_users_after_sql = (
+        "SELECT login FROM users WHERE login LIKE $1 ESCAPE '\\' AND login > $3 ORDER BY login LIMIT $2"
+    )
+    find_similar_sql = (
+        "SELECT login, similarity(login, $1) AS rank FROM users WHERE login ILIKE $2 ESCAPE '\\'"
+        " ORDER BY rank DESC, login LIMIT $3"
+    )
+    find_similar_after_sql = (
+        "SELECT login, similarity(login, $1) AS rank FROM users WHERE login ILIKE $2 ESCAPE '\\'"
+        " AND (similarity(login, $1) < $4 OR (similarity(login, $1) = $4 AND login > $5))"
+        " ORDER BY rank DESC, login LIMIT $3"
+    )
+    add_token_sql = 'UPDATE users SET token = $2 WHERE login = $1'
+    get_token_sql = 'SELECT token FROM users WHERE login = $1'
+    remove_token_sql = 'UPDATE users SET token = NULL WHERE token = $1'
+    get_friends_sql = (
+        'SELECT b.login FROM users a'
+        ' JOIN friendships f ON a.id = f.from_user JOIN users b ON f.to_user = b.id'
+        ' WHERE a.login = $1'
+    )
+    add_friendship_sql = (
+        'WITH inserted AS ('
+        ' INSERT INTO friendships (from_user, to_user)'
+        ' SELECT a.id, b.id FROM users a, users b'
+        ' WHERE (a.login, b.login) IN (($1, $2), ($2, $1)) ORDER BY a.id, b.id'
+        ' RETURNING from_user)'
+        'UPDATE users SET friends_version = friends_version + 1 WHERE id IN (SELECT from_user FROM inserted)'
+    )
+    get_versions_sql = 'SELECT friends_version, invitations_version FROM users WHERE login = $1'
+    # NULL limit and cursor mean no limit and the first page.
+    get_invitations_sql = (
+        'SELECT b.login FROM users a'
+        ' JOIN invitations i ON a.id = i.from_user JOIN users b ON i.to_user = b.id'
+        ' WHERE a.login = $1 AND ($3::varchar IS NULL OR b.login > $3)'
+        ' ORDER BY b.login LIMIT $2'
+    )
+    add_invitation_sql = (
+        'WITH inserted AS ('
+        ' INSERT INTO invitations (from_user, to_user)'
+        ' SELECT a.id, b.id FROM users a, users b'
+        ' WHERE (a.login, b.login) IN (($1, $2), ($2, $1)) ORDER BY a.id, b.id'
+        ' RETURNING from_user)'
+        'UPDATE users SET invitations_version = invitations_version + 1 WHERE id IN (SELECT from_user FROM inserted)'
+    )
+    invite_sql = positional(invite_sql, 'login', 'invited')
+    answer_sql = positional(answer_sql, 'login', 'inviter', 'accepted')
+    remove_invitation_sql = (
+        'WITH removed AS ('
+        ' DELETE FROM invitations i USING users a, users b'
+        ' WHERE i.from_user = a.id AND i.to_user = b.id'
+        ' AND a.login IN ($1, $2) AND b.login IN ($1, $2)'
+        ' RETURNING i.from_user)'
+        'UPDATE users SET invitations_version = invitations_version + 1 WHERE id IN (SELECT from_user FROM removed)'
+    )
+    # One statement for the whole batch, columns are passed as arrays.
+    add_call_records_sql = (
+        'INSERT INTO call_records (call_id, caller, callee, ring_at, answered_at, ended_at, duration, end_reason)'
+        ' SELECT * FROM unnest($1::varchar[], $2::varchar[], $3::varchar[], $4::timestamptz[],'
+        ' $5::timestamptz[], $6::timestamptz[], $7::float8[], $8::varchar[])'
+        ' ON CONFLICT (call_id) DO NOTHING'
+    )
+
+    def __init__(self, pool):
+        self.db = pool
+
+    async def close(self):
+        await self.db.close()
+
+    @asynccontextmanager
+    async def acquire(self):
+        start = time.perf_counter()
+        async with self.db.acquire() as conn:
+            POOL_WAIT.observe(time.perf_counter() - start)
+            yield conn
+
+    async def create_schema(self, statements):
+        async with self.acquire() as conn:
+            for statement in statements:
+                await conn.execute(statement)
+
+    async def _fetch(self, sql, *args):
+        async with self.acquire() as conn:
+            return await conn.fetch(sql, *args)
+
+    async def _fetchrow(self, sql, *args):
+        async with self.acquire() as conn:
+            return await conn.fetchrow(sql, *args)
+
+    async def _execute(self, sql, *args):
+        async with self.acquire() as conn:
+            await conn.execute(sql, *args)
+
+    ###
+    # USERS
+    ###
+
+    async def registered(self, login):
+        return await self._fetchrow(self.registered_sql, login) is not None
+
+    async def get_hash(self, login):
+        row = await self._fetchrow(self.get_hash_sql, login)
+        return row[0] if row else None
+
+    async def set_hash(self, login, password_hash):
+        await self._execute(self.set_hash_sql, login, password_hash)
+
+    async def find_users(self, query, limit, after=None):
+        pattern = escape_like(query) + '%'
+        if after is None:
+            return await self._fetch(self.find_users_sql, pattern, limit)
+        return await self._fetch(self.find_users_after_sql, pattern, limit, after)
+
+    async def find_similar_users(self, query, limit, after=None):
+        pattern = '%' + escape_like(query) + '%'
+        if after is None:
+            return await self._fetch(self.find_similar_sql, query, pattern, limit)
+        last_rank, last_login = after
+        return await self._fetch(self.find_similar_after_sql, query, pattern, limit, last_rank, last_login)
+
+    ###
+    # TOKENS
+    ###
+
+    async def add_token(self, login, token):
+        await self._execute(self.add_token_sql, login, token)
+
+    async def get_token(self, login):
+        row = await self._fetchrow(self.get_token_sql, login)
+        return row[0] if row else None
+
+    async def remove_token(self, token):
+        await self._execute(self.remove_token_sql, token)
+
+    ###
+    # FRIENDS
+    ###
+
+    async def get_friends(self, login):
+        return await self._fetch(self.get_friends_sql, login)
+
+    async def add_friendship(self, login, invited):
+        await self._execute(self.add_friendship_sql, login, invited)
+
+    async def get_versions(self, login):
+        row = await self._fetchrow(self.get_versions_sql, login)
+        return Versions(*row) if row else None
+
+    async def get_invitations(self, login, limit=None, after=None):
+        return await self._fetch(self.get_invitations_sql, login, limit, after)
+
+    async def add_invitation(self, login, invited):
+        await self._execute(self.add_invitation_sql, login, invited)
+
+    async def invite(self, login, invited):
+        row = await self._fetchrow(self.invite_sql, login, invited)
+
+        if row is None:
+            return InviteResult(InviteStatus.UNKNOWN_USER, None)
+        if row['friends']:
+            return InviteResult(InviteStatus.ALREADY_FRIENDS, None)
+        if not row['inserted']:
+            return InviteResult(InviteStatus.ALREADY_INVITED, None)
+        return InviteResult(InviteStatus.INVITED, row['token'])
+
+    async def answer_invitation(self, login, inviter, accepted):
+        row = await self._fetchrow(self.answer_sql, login, inviter, accepted)
+
+        if not row['removed']:
+            return InviteResult(InviteStatus.NO_INVITATION, None)
+        return InviteResult(InviteStatus.ANSWERED, row['token'])
+
+    async def remove_invitation(self, login, invited):
+        await self._execute(self.remove_invitation_sql, login, invited)
+
+    ###
+    # CALLS
+    ###
+
+    async def add_call_records(self, records):
+        await self._execute(self.add_call_records_sql, *[list(column) for column in zip(*records)])
 
 
 async def get_engine(config):
-    return await aiosa.create_engine(config.get('DATABASE', 'URL'))
+    section = 'DATABASE'
+    return await aiosa.create_engine(
+        config.get(section, 'URL'),
+        minsize=config.getint(section, 'POOL MIN', fallback=1),
+        maxsize=config.getint(section, 'POOL MAX', fallback=10),
+        timeout=config.getfloat(section, 'COMMAND TIMEOUT', fallback=60),
+    )
+
+
+async def get_pool(config):
+    section = 'DATABASE'
+    if asyncpg is None:
+        raise RuntimeError('[DATABASE] BACKEND asyncpg needs the asyncpg package')
+
+    return await asyncpg.create_pool(
+        config.get(section, 'URL'),
+        min_size=config.getint(section, 'POOL MIN', fallback=1),
+        max_size=config.getint(section, 'POOL MAX', fallback=10),
+        statement_cache_size=config.getint(section, 'STATEMENT CACHE SIZE', fallback=100),
+        command_timeout=config.getfloat(section, 'COMMAND TIMEOUT', fallback=60),
+        timeout=config.getfloat(section, 'CONNECT TIMEOUT', fallback=60),
+    )
+
+
+async def get_storage(config):
+    if config.get('DATABASE', 'BACKEND', fallback='aiopg') == 'asyncpg':
+        return AsyncpgStorage(await get_pool(config))
+    return DBStorage(await get_engine(config))
+
+
+def get_schema(config):
+    statements = [
+        create_user_table, add_version_columns, create_friendship_table, create_invitation_table,
+        create_call_record_table, create_login_prefix_index
+    ]
+    if config.get('SEARCH', 'MODE', fallback='prefix') == 'trigram':
+        # Needs a role allowed to create extensions.
+        statements += [create_trgm_extension, create_login_trgm_index]
+    return statements
 
 
 async def cleanup_storage(app):
@@ -208,14 +733,9 @@ async def cleanup_storage(app):
 
 def setup_db(app, config):
     async def _setup(app):
-        engine = await get_engine(config)
-        app['storage'] = DBStorage(engine)
-
-        # Create tables.
-        async with engine.acquire() as conn:
-            await conn.execute(create_user_table)
-            await conn.execute(create_friendship_table)
-            await conn.execute(create_invitation_table)
+        storage = await get_storage(config)
+        app['storage'] = storage
+        await storage.create_schema(get_schema(config))
 
     app.on_startup.append(_setup)
     app.on_cleanup.append(cleanup_storage)
@@ -0,0 +1,71 @@
+import asyncio
+import logging
+import math
+
+
+class Timer:
+    __slots__ = ('callback', 'args', 'rounds', 'cancelled')
+
+    def __init__(self, callback, args, rounds):
+        self.callback = callback
+        self.args = args
+        self.rounds = rounds
+        self.cancelled = False
+
+    def cancel(self):
+        # Dropped lazily when the wheel gets to its slot.
+        self.cancelled = True
+
+
+class TimerWheel:
+    """Hashed timer wheel: one task ticks for all timers, scheduling and cancelling are O(1).
+
+    Timers fire up to one tick late, good enough for call timeouts measured in seconds.
+    """
+
+    def __init__(self, tick=1.0, size=512):
+        self.tick = tick
+        self.slots = [[] for _ in range(size)]
+        self.cursor = 0
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+
+    def schedule(self, delay, callback, *args):
+        ticks = max(1, math.ceil(delay / self.tick))
+        timer = Timer(callback, args, (ticks - 1) // len(self.slots))
+        self.slots[(self.cursor + ticks) % len(self.slots)].append(timer)
+        return timer
+
+    def __len__(self):
+        return sum(1 for slot in self.slots for timer in slot if not timer.cancelled)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time()
+        while True:
+            deadline += self.tick
+            await asyncio.sleep(max(0, deadline - loop.time()))
+
+            self.cursor = (self.cursor + 1) % len(self.slots)
+            due, pending = [], []
+            for timer in self.slots[self.cursor]:
+                if timer.cancelled:
+                    continue
+                if timer.rounds:
+                    timer.rounds -= 1
+                    pending.append(timer)
+                else:
+                    due.append(timer)
+            self.slots[self.cursor] = pending
+
+            for timer in due:
+                try:
+                    await timer.callback(*timer.args)
+                except Exception as e:
+                    logging.error('Timer callback %s failed: %r', timer.callback, e)
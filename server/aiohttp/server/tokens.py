@@ -0,0 +1,46 @@
+import time
+from collections import OrderedDict
+
+
+class TokenCache:
+    """Push tokens loaded on demand, least recently used ones are evicted.
+
+    Entries expire after `ttl`, so tokens updated through another worker are picked up.
+    """
+
+    def __init__(self, storage, ttl=300, max_size=100000):
+        self.storage = storage
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries = OrderedDict()
+
+    async def get(self, login):
+        entry = self.entries.get(login, None)
+        if entry is not None and entry[0] > time.monotonic():
+            self.entries.move_to_end(login)
+            return entry[1]
+
+        token = await self.storage.get_token(login)
+        if token:
+            self._put(login, token)
+        else:
+            # Not cached, the user may post it any moment.
+            self.entries.pop(login, None)
+        return token
+
+    async def set(self, login, token):
+        await self.storage.add_token(login, token)
+        self._put(login, token)
+
+    def drop(self, token):
+        for login in [l for l, (_, t) in self.entries.items() if t == token]:
+            del self.entries[login]
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _put(self, login, token):
+        self.entries[login] = (time.monotonic() + self.ttl, token)
+        self.entries.move_to_end(login)
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)